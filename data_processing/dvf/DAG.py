@@ -5,10 +5,12 @@ from airflow.operators.bash import BashOperator
 from airflow.utils.dates import days_ago
 from datetime import timedelta
 from datagouvfr_data_pipelines.config import (
-    AIRFLOW_DAG_HOME,
     AIRFLOW_DAG_TMP,
 )
 from datagouvfr_data_pipelines.data_processing.dvf.task_functions import (
+    download_dvf_data,
+    download_copro,
+    download_dpe,
     alter_dvf_table,
     create_copro_table,
     populate_copro_table,
@@ -22,6 +24,7 @@ from datagouvfr_data_pipelines.data_processing.dvf.task_functions import (
     create_stats_dvf_table,
     get_epci,
     populate_stats_dvf_table,
+    prepare_dvf_ventes,
     process_dvf_stats,
     publish_stats_dvf,
     send_stats_to_minio,
@@ -35,9 +38,7 @@ from datagouvfr_data_pipelines.data_processing.dvf.task_functions import (
 )
 
 TMP_FOLDER = f"{AIRFLOW_DAG_TMP}dvf/"
-DAG_FOLDER = 'datagouvfr_data_pipelines/data_processing/'
 DAG_NAME = 'data_processing_dvf'
-DATADIR = f"{AIRFLOW_DAG_TMP}dvf/data"
 
 default_args = {
     'email': [
@@ -55,6 +56,8 @@ with DAG(
     dagrun_timeout=timedelta(minutes=300),
     tags=["data_processing", "dvf", "stats"],
     default_args=default_args,
+    # nombre d'années traitées en parallèle pour les stats mensuelles
+    params={"nb_workers": 1},
 ) as dag:
 
     clean_previous_outputs = BashOperator(
@@ -62,20 +65,14 @@ with DAG(
         bash_command=f"rm -rf {TMP_FOLDER} && mkdir -p {TMP_FOLDER}",
     )
 
-    download_dvf_data = BashOperator(
+    download_dvf_data = PythonOperator(
         task_id='download_dvf_data',
-        bash_command=(
-            f"sh {AIRFLOW_DAG_HOME}{DAG_FOLDER}"
-            f"dvf/scripts/script_dl_dvf.sh {DATADIR} "
-        )
+        python_callable=download_dvf_data,
     )
 
-    download_copro = BashOperator(
+    download_copro = PythonOperator(
         task_id='download_copro',
-        bash_command=(
-            f"sh {AIRFLOW_DAG_HOME}{DAG_FOLDER}"
-            f"dvf/scripts/script_dl_copro.sh {DATADIR} "
-        )
+        python_callable=download_copro,
     )
 
     create_copro_table = PythonOperator(
@@ -88,12 +85,9 @@ with DAG(
         python_callable=populate_copro_table,
     )
 
-    download_dpe = BashOperator(
+    download_dpe = PythonOperator(
         task_id='download_dpe',
-        bash_command=(
-            f"sh {AIRFLOW_DAG_HOME}{DAG_FOLDER}"
-            f"dvf/scripts/script_dl_dpe.sh {DATADIR} "
-        )
+        python_callable=download_dpe,
     )
 
     process_dpe = PythonOperator(
@@ -141,6 +135,11 @@ with DAG(
         python_callable=get_epci,
     )
 
+    prepare_dvf_ventes = PythonOperator(
+        task_id='prepare_dvf_ventes',
+        python_callable=prepare_dvf_ventes,
+    )
+
     process_dvf_stats = PythonOperator(
         task_id='process_dvf_stats',
         python_callable=process_dvf_stats,
@@ -203,11 +202,12 @@ with DAG(
 
     download_dvf_data.set_upstream(clean_previous_outputs)
 
-    download_copro.set_upstream(download_dvf_data)
+    # les téléchargements sont indépendants et se font en parallèle
+    download_copro.set_upstream(clean_previous_outputs)
     create_copro_table.set_upstream(download_copro)
     populate_copro_table.set_upstream(create_copro_table)
 
-    download_dpe.set_upstream(download_dvf_data)
+    download_dpe.set_upstream(clean_previous_outputs)
     process_dpe.set_upstream(download_dpe)
     create_dpe_table.set_upstream(process_dpe)
     populate_dpe_table.set_upstream(create_dpe_table)
@@ -219,7 +219,8 @@ with DAG(
     index_dvf_table.set_upstream(alter_dvf_table)
 
     get_epci.set_upstream(download_dvf_data)
-    process_dvf_stats.set_upstream(get_epci)
+    prepare_dvf_ventes.set_upstream(get_epci)
+    process_dvf_stats.set_upstream(prepare_dvf_ventes)
 
     create_distribution_and_stats_whole_period.set_upstream(process_dvf_stats)
 
@@ -1,6 +0,0 @@
-DATADIR="$1"
-
-URL_copro="https://www.data.gouv.fr/fr/datasets/r/3ea8e2c3-0038-464a-b17e-cd5c91f65ce2"
-curl -o $DATADIR/copro.csv $URL_copro -L
-
-cd $DATADIR && ls -lh
\ No newline at end of file
@@ -1,5 +1,5 @@
-ALTER TABLE dvf.dvf
+ALTER TABLE dvf.dvf_staging
 ADD section_prefixe VARCHAR(5);
 
-UPDATE dvf.dvf
+UPDATE dvf.dvf_staging
 SET section_prefixe = SUBSTRING(id_parcelle, 6, 5);
\ No newline at end of file
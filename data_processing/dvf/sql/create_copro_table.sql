@@ -1,8 +1,7 @@
 DO $$ 
 BEGIN
-    IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'copro' AND TABLE_SCHEMA = 'dvf') THEN
-        TRUNCATE TABLE dvf.copro;
-    ELSE
+    /* la table est remplacée par une copie chargée à côté, cf copy_file */
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'copro' AND TABLE_SCHEMA = 'dvf') THEN
         CREATE UNLOGGED TABLE dvf.copro (
             epci VARCHAR(9),
             commune VARCHAR(50),
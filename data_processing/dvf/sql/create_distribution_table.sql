@@ -1,8 +1,7 @@
 DO $$ 
 BEGIN
-    IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'distribution_prix' AND TABLE_SCHEMA = 'dvf') THEN
-        TRUNCATE TABLE dvf.distribution_prix;
-    ELSE
+    /* la table est remplacée par une copie chargée à côté, cf copy_file */
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'distribution_prix' AND TABLE_SCHEMA = 'dvf') THEN
         CREATE UNLOGGED TABLE dvf.distribution_prix (
             code_geo VARCHAR(20),
             type_local VARCHAR(11),
@@ -1,9 +1,12 @@
-DO $$ 
+DO $$
 BEGIN
-    IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'stats_dvf' AND TABLE_SCHEMA = 'dvf') THEN
-        TRUNCATE TABLE dvf.stats_dvf;
-    ELSE
-        CREATE UNLOGGED TABLE dvf.stats_dvf (
+    /* l'ancienne table, non partitionnée, est recréée une seule fois */
+    IF EXISTS (SELECT * FROM pg_class WHERE oid = to_regclass('dvf.stats_dvf') AND relkind = 'r') THEN
+        DROP TABLE dvf.stats_dvf;
+    END IF;
+    /* une partition par année, remplacée par populate_stats_dvf_table quand l'année change */
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'stats_dvf' AND TABLE_SCHEMA = 'dvf') THEN
+        CREATE TABLE dvf.stats_dvf (
             code_geo VARCHAR(20),
             nb_ventes_maison INT,
             moy_prix_m2_maison INT,
@@ -21,10 +24,10 @@ BEGIN
             libelle_geo VARCHAR(100),
             code_parent VARCHAR(10),
             echelle_geo VARCHAR(15)
-        );
+        ) PARTITION BY RANGE (annee_mois);
         /* PRIMARY KEY (echelle_geo, code_geo, annee_mois, code_parent)); */
-        CREATE INDEX echelle_geo_idx ON stats_dvf USING btree (echelle_geo);
-        CREATE INDEX code_geo_idx ON stats_dvf USING btree (code_geo);
-        CREATE INDEX code_parent_idx ON stats_dvf USING btree (code_parent);
+        CREATE INDEX echelle_geo_idx ON dvf.stats_dvf USING btree (echelle_geo);
+        CREATE INDEX code_geo_idx ON dvf.stats_dvf USING btree (code_geo);
+        CREATE INDEX code_parent_idx ON dvf.stats_dvf USING btree (code_parent);
     END IF;
 END $$;
\ No newline at end of file
@@ -1,8 +1,7 @@
 DO $$ 
 BEGIN
-    IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'stats_whole_period' AND TABLE_SCHEMA = 'dvf') THEN
-        TRUNCATE TABLE dvf.stats_whole_period;
-    ELSE
+    /* la table est remplacée par une copie chargée à côté, cf copy_file */
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'stats_whole_period' AND TABLE_SCHEMA = 'dvf') THEN
         CREATE UNLOGGED TABLE dvf.stats_whole_period (
             code_geo VARCHAR(20),
             libelle_geo VARCHAR(100),
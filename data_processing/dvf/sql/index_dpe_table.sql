@@ -1 +1 @@
-CREATE INDEX parcelle_id_idx ON dvf.dpe USING btree (parcelle_id);
+CREATE INDEX parcelle_id_idx_staging ON dvf.dpe_staging USING btree (parcelle_id);
@@ -1,2 +1,2 @@
-CREATE INDEX code_commune_idx ON dvf.dvf USING btree (code_commune);
-CREATE INDEX section_prefixe_idx ON dvf.dvf USING btree (section_prefixe);
+CREATE INDEX code_commune_idx_staging ON dvf.dvf_staging USING btree (code_commune);
+CREATE INDEX section_prefixe_idx_staging ON dvf.dvf_staging USING btree (section_prefixe);
@@ -8,28 +8,54 @@ from datagouvfr_data_pipelines.config import (
     MINIO_BUCKET_DATA_PIPELINE_OPEN,
 )
 from datagouvfr_data_pipelines.utils.postgres import (
+    execute_query,
     execute_sql_file,
-    copy_file
+    copy_dataframes,
+    copy_file,
+    get_connection,
+    replace_partition,
+    swap_tables,
 )
 from datagouvfr_data_pipelines.utils.datagouv import post_remote_resource, DATAGOUV_URL
+from datagouvfr_data_pipelines.utils.download import download_files
 from datagouvfr_data_pipelines.utils.mattermost import send_message
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 import gc
 import glob
+import hashlib
 from unidecode import unidecode
 import numpy as np
 import os
 import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from datetime import datetime
 import json
 import shutil
+import tarfile
 import zipfile
 from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
 
 DAG_FOLDER = "datagouvfr_data_pipelines/data_processing/"
 DATADIR = f"{AIRFLOW_DAG_TMP}dvf/data"
 DPEDIR = f"{DATADIR}/dpe/"
+# découpage des fichiers DPE pour les joindre sans tout charger en mémoire
+DPE_NB_BUCKETS = 32
+DPE_CHUNK_SIZE = 1000000
+COPRO_CHUNK_SIZE = 100000
+# nombre de fichiers téléchargés en même temps
+DOWNLOAD_WORKERS = 4
+DVF_URL = "https://files.data.gouv.fr/geo-dvf/latest/csv/{year}/full.csv.gz"
+CADASTRE_URL = "https://cadastre.data.gouv.fr/data/dgfip-pci-vecteur-latest.json"
+DEPARTEMENTS_URL = "https://www.insee.fr/fr/statistiques/fichier/6051727/departement_2022.csv"
+COMMUNES_URL = "https://www.insee.fr/fr/statistiques/fichier/6051727/commune_2022.csv"
+COPRO_URL = "https://www.data.gouv.fr/fr/datasets/r/3ea8e2c3-0038-464a-b17e-cd5c91f65ce2"
+DPE_URL = "https://www.data.gouv.fr/fr/datasets/r/ad4bb2f6-0f40-46d2-a636-8d2604532f74"
+# ventes préparées et stats de chaque année, gardées d'un run à l'autre
+CACHEDIR = f"{AIRFLOW_DAG_TMP}dvf_cache/"
 schema = 'dvf'
 
 if AIRFLOW_ENV == 'prod':
@@ -107,6 +133,7 @@ def index_dvf_table():
         ],
         schema,
     )
+    swap_staging_table("dvf")
 
 
 def create_stats_dvf_table():
@@ -160,11 +187,11 @@ def create_whole_period_table():
     )
 
 
-def populate_utils(files, table, has_header):
+def populate_utils(files, table, has_header, use_staging_table=False):
     format_files = []
     for file in files:
         format_files.append(
-            {"source_path": f"{DATADIR}/", "source_name": file.split("/")[-1]}
+            {"source_path": os.path.dirname(file) + "/", "source_name": os.path.basename(file)}
         )
     copy_file(
         PG_HOST=conn.host,
@@ -176,9 +203,20 @@ def populate_utils(files, table, has_header):
         list_files=format_files,
         PG_SCHEMA=schema,
         has_header=has_header,
+        use_staging_table=use_staging_table,
     )
 
 
+def swap_staging_table(name):
+    # la table chargée et indexée à côté remplace celle utilisée par l'API
+    table = f'{schema}.{name}' if schema else name
+    with get_connection(
+        conn.host, conn.port, conn.schema, conn.login, conn.password, schema
+    ) as pg_conn:
+        with pg_conn.cursor() as cur:
+            swap_tables(cur, table, f"{table}_staging")
+
+
 def populate_copro_table():
     mapping = {
         "EPCI": "epci",
@@ -252,41 +290,56 @@ def populate_copro_table():
         "Copro dans ACV": "copro_dans_acv",
         "Copro dans PVD": "copro_dans_pvd",
     }
-    copro = pd.read_csv(
-        f"{DATADIR}/copro.csv",
-        dtype=str,
-        usecols=mapping.keys()
-    )
-    copro = copro.rename(mapping, axis=1)
-    copro = copro.drop(columns=[
-        "code_insee_commune_1",
-        "prefixe_1",
-        "section_1",
-        "numero_parcelle_1",
-        "code_insee_commune_2",
-        "prefixe_2",
-        "section_2",
-        "numero_parcelle_2",
-        "code_insee_commune_3",
-        "prefixe_3",
-        "section_3",
-        "numero_parcelle_3",
-    ])
-    mask = copro['commune'].str.len() == 5
-    copro = copro.loc[mask]
-    copro.to_csv(f"{DATADIR}/copro_clean.csv", index=False)
     table = f'{schema}.copro' if schema else "copro"
-    populate_utils([f"{DATADIR}/copro_clean.csv"], table, True)
+    # le fichier est nettoyé par morceaux envoyés directement à la base
+    copy_dataframes(
+        PG_HOST=conn.host,
+        PG_PORT=conn.port,
+        PG_DB=conn.schema,
+        PG_TABLE=table,
+        PG_USER=conn.login,
+        PG_PASSWORD=conn.password,
+        dataframes=iter_copro_chunks(mapping),
+        PG_SCHEMA=schema,
+        use_staging_table=True,
+    )
+
+
+def iter_copro_chunks(mapping):
+    for copro in pd.read_csv(
+        CACHEDIR + "copro.csv",
+        dtype=str,
+        usecols=mapping.keys(),
+        chunksize=COPRO_CHUNK_SIZE,
+    ):
+        copro = copro.rename(mapping, axis=1)
+        copro = copro.drop(columns=[
+            "code_insee_commune_1",
+            "prefixe_1",
+            "section_1",
+            "numero_parcelle_1",
+            "code_insee_commune_2",
+            "prefixe_2",
+            "section_2",
+            "numero_parcelle_2",
+            "code_insee_commune_3",
+            "prefixe_3",
+            "section_3",
+            "numero_parcelle_3",
+        ])
+        mask = copro['commune'].str.len() == 5
+        yield copro.loc[mask]
 
 
 def populate_distribution_table():
     table = f'{schema}.distribution_prix' if schema else "distribution_prix"
-    populate_utils([f"{DATADIR}/distribution_prix.csv"], table, True)
+    populate_utils([f"{DATADIR}/distribution_prix.csv"], table, True, use_staging_table=True)
 
 
 def populate_dvf_table():
-    files = glob.glob(f"{DATADIR}/full*.csv")
-    table = f'{schema}.dvf' if schema else "dvf"
+    files = sorted(glob.glob(CACHEDIR + "full_*.csv.gz"))
+    # chargée dans dvf_staging, qui remplace dvf une fois indexée
+    table = f'{schema}.dvf_staging' if schema else "dvf_staging"
     populate_utils(files, table, True)
 
 
@@ -308,18 +361,189 @@ def alter_dvf_table():
 
 
 def populate_stats_dvf_table():
+    # la table est partitionnée par année : seules les partitions des années dont
+    # le fichier a changé (ou dont le nombre de lignes ne correspond pas) sont
+    # rechargées à côté puis échangées, la table reste complète pendant le chargement
     table = f'{schema}.stats_dvf' if schema else "stats_dvf"
-    populate_utils([f"{DATADIR}/stats_dvf_api.csv"], table, True)
+    manifest = load_manifest()
+    loaded = execute_query(
+        PG_HOST=conn.host,
+        PG_PORT=conn.port,
+        PG_DB=conn.schema,
+        PG_USER=conn.login,
+        PG_PASSWORD=conn.password,
+        sql=f"SELECT LEFT(annee_mois, 4) AS year, COUNT(*) AS nb_rows FROM {table} GROUP BY 1",
+        PG_SCHEMA=schema,
+    )
+    # True si la table est vide
+    loaded = {} if loaded is True else {row["year"]: row["nb_rows"] for row in loaded}
+    years = [str(year) for year in get_dvf_years()]
+    for year in loaded:
+        if year not in years:
+            print(f"Removing {year} from {table}")
+            execute_query(
+                PG_HOST=conn.host,
+                PG_PORT=conn.port,
+                PG_DB=conn.schema,
+                PG_USER=conn.login,
+                PG_PASSWORD=conn.password,
+                sql=f"DROP TABLE IF EXISTS {table}_{year}",
+                PG_SCHEMA=schema,
+            )
+            manifest["stats_dvf_table"].pop(year, None)
+    for year in years:
+        api = manifest["stats_dvf_api"][year]
+        if (
+            manifest["stats_dvf_table"].get(year) == api["key"]
+            and loaded.get(year) == api["rows"]
+        ):
+            print(year, "already up to date in", table)
+            continue
+        print(f"Loading {year} into {table}")
+        replace_partition(
+            PG_HOST=conn.host,
+            PG_PORT=conn.port,
+            PG_DB=conn.schema,
+            PG_TABLE=table,
+            PG_USER=conn.login,
+            PG_PASSWORD=conn.password,
+            partition=f"stats_dvf_{year}",
+            column="annee_mois",
+            lower_bound=f"{year}-01",
+            upper_bound=f"{int(year) + 1}-01",
+            list_files=[
+                {"source_path": f"{DATADIR}/", "source_name": f"stats_dvf_api_{year}.csv"}
+            ],
+            PG_SCHEMA=schema,
+            has_header=True,
+        )
+        manifest["stats_dvf_table"][year] = api["key"]
+        save_manifest(manifest)
+    save_manifest(manifest)
 
 
 def populate_dpe_table():
-    table = f'{schema}.dpe' if schema else "dpe"
+    # chargée dans dpe_staging, qui remplace dpe une fois indexée
+    table = f'{schema}.dpe_staging' if schema else "dpe_staging"
     populate_utils([f"{DATADIR}/all_dpe.csv"], table, False)
 
 
 def populate_whole_period_table():
     table = f'{schema}.stats_whole_period' if schema else "stats_whole_period"
-    populate_utils([f"{DATADIR}/stats_whole_period.csv"], table, True)
+    populate_utils([f"{DATADIR}/stats_whole_period.csv"], table, True, use_staging_table=True)
+
+
+def download_with_cache(name, urls, skip_not_found=False):
+    # les fichiers déjà présents ne sont téléchargés à nouveau que s'ils ont changé,
+    # les téléchargements interrompus reprennent où ils s'étaient arrêtés
+    os.makedirs(CACHEDIR, exist_ok=True)
+    validators_file = CACHEDIR + f"validators_{name}.json"
+    validators = {}
+    if os.path.isfile(validators_file):
+        with open(validators_file, "r") as f:
+            validators = json.load(f)
+    validators = {
+        url["url"]: validators[url["url"]]
+        for url in urls
+        if validators.get(url["url"]) and os.path.isfile(url["dest_path"] + url["dest_name"])
+    }
+    validators = download_files(
+        urls,
+        max_workers=DOWNLOAD_WORKERS,
+        resume=True,
+        validators=validators,
+        skip_not_found=skip_not_found,
+    )
+    with open(validators_file + ".tmp", "w") as f:
+        json.dump(validators, f, indent=2)
+    os.replace(validators_file + ".tmp", validators_file)
+    return validators
+
+
+def download_dvf_data():
+    os.makedirs(DATADIR, exist_ok=True)
+    curr_year = datetime.today().year
+    dvf_urls = [
+        {
+            "url": DVF_URL.format(year=year),
+            "dest_path": CACHEDIR,
+            "dest_name": f"full_{year}.csv.gz",
+        }
+        for year in range(curr_year - 5, curr_year + 1)
+    ]
+    other_urls = [
+        {
+            "url": DEPARTEMENTS_URL,
+            "dest_path": f"{DATADIR}/",
+            "dest_name": "departements.csv",
+        },
+        {
+            "url": COMMUNES_URL,
+            "dest_path": f"{DATADIR}/",
+            "dest_name": "communes.csv",
+        },
+        {
+            "url": CADASTRE_URL,
+            "dest_path": CACHEDIR,
+            "dest_name": "dgfip-pci-vecteur-latest.json",
+        },
+    ]
+    # les années pas encore publiées sont ignorées
+    validators = download_with_cache("dvf", dvf_urls + other_urls, skip_not_found=True)
+    for url in other_urls:
+        if validators[url["url"]] is None:
+            raise Exception(f"{url['url']} not found")
+    # les fichiers gz sont lus tels quels, on ne garde que ceux de la période
+    kept = [url["dest_name"] for url in dvf_urls if validators[url["url"]] is not None]
+    for file in glob.glob(CACHEDIR + "full_*.csv.gz"):
+        if os.path.basename(file) not in kept:
+            os.remove(file)
+    print("DVF years:", get_dvf_years())
+    # la liste des sections n'est recalculée que si le fichier du cadastre a changé
+    if (
+        not os.path.isfile(CACHEDIR + "sections.txt")
+        or os.path.getmtime(CACHEDIR + "sections.txt")
+        < os.path.getmtime(CACHEDIR + "dgfip-pci-vecteur-latest.json")
+    ):
+        write_sections()
+    shutil.copy(CACHEDIR + "sections.txt", DATADIR + "/sections.txt")
+
+
+def write_sections():
+    with open(CACHEDIR + "dgfip-pci-vecteur-latest.json", "r") as f:
+        cadastre = json.load(f)
+    # noms des archives des feuilles cadastrales, de la forme edigeo-<section>.tar.bz2
+    feuilles = [
+        feuille["name"]
+        for entry in cadastre
+        for edigeo in entry["contents"] if edigeo["name"].endswith("edigeo")
+        for dossier in edigeo["contents"] if dossier["name"].endswith("feuilles")
+        for departement in dossier["contents"]
+        for commune in departement["contents"]
+        for feuille in commune["contents"]
+    ]
+    with open(CACHEDIR + "sections.txt.tmp", "w") as f:
+        for feuille in feuilles:
+            f.write(
+                feuille.split("/")[-1].replace("edigeo-", "").replace(".tar.bz2", "") + "\n"
+            )
+    os.replace(CACHEDIR + "sections.txt.tmp", CACHEDIR + "sections.txt")
+    print(len(feuilles), "sections")
+
+
+def download_copro():
+    download_with_cache(
+        "copro",
+        [{"url": COPRO_URL, "dest_path": CACHEDIR, "dest_name": "copro.csv"}],
+    )
+
+
+def download_dpe():
+    # l'archive est lue directement par process_dpe
+    download_with_cache(
+        "dpe",
+        [{"url": DPE_URL, "dest_path": CACHEDIR, "dest_name": "dpe.tar.gz"}],
+    )
 
 
 def get_epci():
@@ -345,6 +569,216 @@ def get_epci():
     ).to_csv(DATADIR + "/epci.csv", sep=",", encoding="utf8", index=False)
 
 
+def get_dvf_years():
+    return sorted(
+        [
+            int(f.replace("full_", "").replace(".csv.gz", ""))
+            for f in os.listdir(CACHEDIR)
+            if f.startswith("full_") and f.endswith(".csv.gz")
+        ]
+    )
+
+
+def prepare_ventes_year(year, epci):
+    to_keep = [
+        "id_mutation",
+        "date_mutation",
+        "code_departement",
+        "code_commune",
+        "id_parcelle",
+        "nature_mutation",
+        "code_type_local",
+        "type_local",
+        "valeur_fonciere",
+        "surface_reelle_bati",
+    ]
+    natures_of_interest = [
+        "Vente",
+        "Vente en l'état futur d'achèvement",
+        "Adjudication",
+    ]
+    types_of_interest = [1, 2, 4]
+    df = pd.read_csv(
+        CACHEDIR + f"full_{year}.csv.gz",
+        sep=",",
+        encoding="utf8",
+        dtype={
+            "code_commune": str,
+            "code_departement": str,
+            "nature_mutation": "category",
+            "type_local": "category",
+        },
+        usecols=to_keep,
+    )
+    # les fichiers d'entrée contiennent entre 4 et 8% de doublons purs
+    df = df.drop_duplicates()
+    # certaines communes ne sont pas dans des EPCI
+    df = pd.merge(
+        df,
+        epci[['code_commune', 'code_epci']],
+        on="code_commune",
+        how="left"
+    )
+    df["code_section"] = df["id_parcelle"].str[:10]
+    df = df.drop("id_parcelle", axis=1)
+    # toutes les communes et sections de DVF sont gardées pour les libellés
+    df[["code_commune", "code_section"]].drop_duplicates().to_parquet(
+        CACHEDIR + f"codes_{year}.parquet",
+        index=False,
+    )
+
+    # types_bien = {
+    #     1: "Maison",
+    #     2: "Appartement",
+    #     3: "Dépendance",
+    #     4: "Local industriel. commercial ou assimilé",
+    #     NaN: terres (cf nature_culture)
+    # }
+
+    # filtres sur les ventes et les types de biens à considérer
+    # choix : les terres et/ou dépendances ne rendent pas une mutation
+    # multi-type
+    ventes = df.loc[
+        (df["nature_mutation"].isin(natures_of_interest)) &
+        (df["code_type_local"].isin(types_of_interest))
+    ].copy()
+    del df
+    ventes["month"] = ventes["date_mutation"].str.slice(5, 7).astype("int8")
+    ventes["code_type_local"] = ventes["code_type_local"].astype("int8")
+    print("Après déduplication et filtre types et natures :", len(ventes))
+
+    # on ne garde que les ventes d'un seul bien
+    # cf historique pour les ventes multi-types
+    ventes["mono_bien"] = ~ventes["id_mutation"].duplicated(keep=False)
+    print("Ventes d'un seul bien :", ventes["mono_bien"].sum())
+
+    # pas de prix ou pas de surface : prix_m2 vide
+    ventes["prix_m2"] = (
+        ventes["valeur_fonciere"] /
+        ventes["surface_reelle_bati"]
+    ).replace([np.inf, -np.inf], np.nan)
+
+    ventes = ventes[[
+        "code_departement",
+        "code_epci",
+        "code_commune",
+        "code_section",
+        "code_type_local",
+        "type_local",
+        "month",
+        "mono_bien",
+        "prix_m2",
+    ]]
+    for c in ["code_departement", "code_epci", "code_commune", "code_section"]:
+        ventes[c] = ventes[c].astype("category")
+    ventes["type_local"] = ventes["type_local"].cat.remove_unused_categories()
+    ventes.to_parquet(CACHEDIR + f"ventes_{year}.parquet", index=False)
+
+
+def get_file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_manifest():
+    # pour chaque année : empreinte des sources des ventes préparées ("ventes"),
+    # des stats calculées ("stats"), des fichiers de l'API ("stats_dvf_api")
+    # et de ce qui est chargé en base ("stats_dvf_table")
+    manifest = {"ventes": {}, "stats": {}, "stats_dvf_api": {}, "stats_dvf_table": {}}
+    if os.path.isfile(CACHEDIR + "manifest.json"):
+        with open(CACHEDIR + "manifest.json", "r") as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(manifest):
+    with open(CACHEDIR + "manifest.json.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(CACHEDIR + "manifest.json.tmp", CACHEDIR + "manifest.json")
+
+
+def prepare_dvf_ventes():
+    # chaque année n'est lue et filtrée qu'une fois pour les stats et distributions,
+    # et seulement si son fichier (ou les EPCI) a changé depuis le dernier run
+    os.makedirs(CACHEDIR, exist_ok=True)
+    manifest = load_manifest()
+    epci = pd.read_csv(
+        DATADIR + "/epci.csv",
+        sep=",",
+        encoding="utf8",
+        dtype=str
+    )
+    epci_hash = get_file_hash(DATADIR + "/epci.csv")
+    for year in get_dvf_years():
+        source_hash = get_file_hash(CACHEDIR + f"full_{year}.csv.gz") + "-" + epci_hash
+        if (
+            manifest["ventes"].get(str(year)) == source_hash
+            and os.path.isfile(CACHEDIR + f"ventes_{year}.parquet")
+            and os.path.isfile(CACHEDIR + f"codes_{year}.parquet")
+        ):
+            print(year, "unchanged, using cache")
+            continue
+        print("Starting with", year)
+        prepare_ventes_year(year, epci)
+        manifest["ventes"][str(year)] = source_hash
+        save_manifest(manifest)
+        gc.collect()
+        print("Done with", year)
+
+
+def load_ventes(years, columns=None, mono_bien=False):
+    ventes = [
+        pd.read_parquet(
+            CACHEDIR + f"ventes_{year}.parquet",
+            columns=columns,
+            filters=[("mono_bien", "=", True)] if mono_bien else None,
+        )
+        for year in years
+    ]
+    # les codes gardent des catégories communes à toutes les années, triées
+    # pour que les groupby restent dans l'ordre des codes
+    for c in ventes[0].select_dtypes("category").columns:
+        categories = union_categoricals(
+            [v[c] for v in ventes], sort_categories=True
+        ).categories
+        for v in ventes:
+            v[c] = v[c].cat.set_categories(categories)
+    return pd.concat(ventes, ignore_index=True)
+
+
+def split_in_buckets(file, columns, prefix):
+    # répartit les lignes dans DPE_NB_BUCKETS fichiers selon un hash de
+    # batiment_groupe_id : un même bâtiment est toujours dans le même fichier
+    writers = {}
+    try:
+        for chunk in pd.read_csv(file, dtype=str, usecols=columns, chunksize=DPE_CHUNK_SIZE):
+            buckets = pd.util.hash_pandas_object(
+                chunk['batiment_groupe_id'], index=False
+            ).values % DPE_NB_BUCKETS
+            order = np.argsort(buckets, kind="stable")
+            bounds = np.searchsorted(buckets[order], np.arange(DPE_NB_BUCKETS + 1))
+            table = pa.Table.from_pandas(
+                chunk.iloc[order],
+                schema=pa.schema([(c, pa.string()) for c in chunk.columns]),
+                preserve_index=False,
+            )
+            for bucket in np.flatnonzero(np.diff(bounds)):
+                if bucket not in writers:
+                    writers[bucket] = pq.ParquetWriter(
+                        DPEDIR + f"{prefix}_{bucket}.parquet", table.schema
+                    )
+                writers[bucket].write_table(
+                    table.slice(bounds[bucket], bounds[bucket + 1] - bounds[bucket])
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return set(writers)
+
+
 def process_dpe():
     cols_dpe = [
         'batiment_groupe_id',
@@ -364,42 +798,57 @@ def process_dpe():
         "batiment_groupe_id",
         "parcelle_id"
     ]
-    print("Import et traitement DPE infos...")
-    dpe = pd.read_csv(
-        DATADIR + '/csv/batiment_groupe_dpe_representatif_logement.csv',
-        dtype=str,
-        usecols=cols_dpe
-    )
-    # dpe['date_etablissement_dpe'] = dpe['date_etablissement_dpe'].str.slice(0, 10)
-    # dpe['surface_habitable_logement'] = dpe['surface_habitable_logement'].apply(
-    #     lambda x: round(float(x), 2)
-    # )
-    dpe.set_index('batiment_groupe_id', inplace=True)
-    print("Import DPE parcelles...")
-    parcelles = pd.read_csv(
-        DATADIR + '/csv/rel_batiment_groupe_parcelle.csv',
-        dtype=str,
-        usecols=cols_parcelles
-    )
-    parcelles.set_index('batiment_groupe_id', inplace=True)
+    # les deux tables ne tiennent pas ensemble en mémoire à l'échelle nationale :
+    # elles sont découpées par bâtiment et jointes morceau par morceau.
+    # Elles sont lues directement dans l'archive, parcourue une seule fois
+    os.makedirs(DPEDIR, exist_ok=True)
+    buckets = None
+    buckets_parcelles = None
+    with tarfile.open(CACHEDIR + "dpe.tar.gz", "r:gz") as tar:
+        for member in tar:
+            if member.name.endswith("/batiment_groupe_dpe_representatif_logement.csv"):
+                print("Découpage DPE infos...")
+                buckets = split_in_buckets(tar.extractfile(member), cols_dpe, "dpe")
+            elif member.name.endswith("/rel_batiment_groupe_parcelle.csv"):
+                print("Découpage DPE parcelles...")
+                buckets_parcelles = split_in_buckets(
+                    tar.extractfile(member), cols_parcelles, "parcelles"
+                )
+    for file_name, file_buckets in [
+        ("batiment_groupe_dpe_representatif_logement.csv", buckets),
+        ("rel_batiment_groupe_parcelle.csv", buckets_parcelles),
+    ]:
+        if file_buckets is None:
+            raise Exception(f"{file_name} not found in the BDNB archive")
     print("Jointure des deux tables...")
-    dpe_parcelled = dpe.join(
-        parcelles,
-        on='batiment_groupe_id',
-        how='left'
-    )
-    del dpe
-    del parcelles
-    dpe_parcelled.reset_index(inplace=True)
-    dpe_parcelled = dpe_parcelled.dropna(subset=['parcelle_id'])
-    print("Export de la table finale...")
-    dpe_parcelled.to_csv(
-        DATADIR + "/all_dpe.csv",
-        sep=",",
-        index=False,
-        encoding="utf8",
-        header=False
-    )
+    with open(DATADIR + "/all_dpe.csv", "w", encoding="utf8") as f:
+        # seuls les bâtiments présents dans les deux tables sont gardés
+        for bucket in sorted(buckets & buckets_parcelles):
+            dpe = pd.read_parquet(DPEDIR + f"dpe_{bucket}.parquet")
+            # dpe['date_etablissement_dpe'] = dpe['date_etablissement_dpe'].str.slice(0, 10)
+            # dpe['surface_habitable_logement'] = dpe['surface_habitable_logement'].apply(
+            #     lambda x: round(float(x), 2)
+            # )
+            dpe.set_index('batiment_groupe_id', inplace=True)
+            parcelles = pd.read_parquet(DPEDIR + f"parcelles_{bucket}.parquet")
+            parcelles.set_index('batiment_groupe_id', inplace=True)
+            dpe_parcelled = dpe.join(
+                parcelles,
+                on='batiment_groupe_id',
+                how='left'
+            )
+            del dpe
+            del parcelles
+            dpe_parcelled.reset_index(inplace=True)
+            dpe_parcelled = dpe_parcelled.dropna(subset=['parcelle_id'])
+            dpe_parcelled.to_csv(
+                f,
+                sep=",",
+                index=False,
+                header=False
+            )
+            print(f"Bucket {bucket} : {len(dpe_parcelled)} lignes")
+    shutil.rmtree(DPEDIR)
 
 
 def index_dpe_table():
@@ -417,295 +866,160 @@ def index_dpe_table():
         ],
         schema,
     )
+    swap_staging_table("dpe")
+
+
+def get_monthly_stats_echelle(ventes_nodup, echelle):
+    # nombre, moyenne et médiane des prix au m² par code, mois et type de bien
+    stats = ventes_nodup.groupby(
+        [f"code_{echelle}", "month", "type_local"], observed=True
+    )["prix_m2"].agg(["count", "mean", "median"]).unstack()
+    prefixes = {"count": "nb_ventes_", "mean": "moy_prix_m2_", "median": "med_prix_m2_"}
+    stats.columns = [
+        prefixes[stat] + unidecode(type_local.split(" ")[0].lower())
+        for stat, type_local in stats.columns
+    ]
+
+    # appartement + maison
+    combined = ventes_nodup.loc[
+        ventes_nodup["code_type_local"].isin([1, 2])
+    ].groupby(
+        [f"code_{echelle}", "month"], observed=True
+    )["prix_m2"].agg(["count", "mean", "median"])
+    combined.columns = [prefixes[stat] + "apt_maison" for stat in combined.columns]
+
+    # les codes n'ayant que des ventes de locaux sur le mois ne sont pas gardés
+    # groupby ne trie pas les catégories observées, on remet les codes dans l'ordre
+    stats = stats.join(combined, how="inner").sort_index()
+    for c in stats.columns:
+        if any([k in c for k in ["moy_", "med_"]]):
+            stats[c] = stats[c].round()
+    return stats.reset_index().rename(columns={f"code_{echelle}": "code_geo"})
+
+
+def get_monthly_stats_nation(ventes, ventes_nodup, types_bien, types_of_interest, month_range):
+    # les volumes sont calculés sur toutes les ventes, les prix sur les ventes d'un seul bien
+    nb_ventes = ventes.groupby(["month", "code_type_local"]).size()
+    nb_apt_maison = ventes.loc[
+        ventes["code_type_local"].isin([1, 2])
+    ].groupby("month").size()
+    prix_by_type = dict(list(
+        ventes_nodup.groupby(["month", "code_type_local"])["prix_m2"]
+    ))
+    prix_apt_maison = dict(list(
+        ventes_nodup.loc[
+            ventes_nodup["code_type_local"].isin([1, 2])
+        ].groupby("month")["prix_m2"]
+    ))
+    empty = pd.Series(dtype=float)
+    rows = []
+    for m in month_range:
+        general = {"code_geo": "nation", "month": m}
+        for t in types_of_interest:
+            libelle = unidecode(types_bien[t].split(" ")[0].lower())
+            prix = prix_by_type.get((m, t), empty)
+            general["nb_ventes_" + libelle] = nb_ventes.get((m, t), 0)
+            general["moy_prix_m2_" + libelle] = np.round(prix.mean())
+            general["med_prix_m2_" + libelle] = np.round(prix.median())
+        prix = prix_apt_maison.get(m, empty)
+        general["nb_ventes_apt_maison"] = nb_apt_maison.get(m, 0)
+        general["moy_prix_m2_apt_maison"] = np.round(prix.mean())
+        general["med_prix_m2_apt_maison"] = np.round(prix.median())
+        rows.append(general)
+    return pd.DataFrame(rows)
+
+
+def get_types_bien(year):
+    return dict(
+        pd.read_parquet(
+            CACHEDIR + f"ventes_{year}.parquet",
+            columns=["code_type_local", "type_local"],
+        ).drop_duplicates().values
+    )
 
 
-def process_dvf_stats():
-    years = sorted(
+def get_stats_year(year):
+    # calcule les stats mensuelles d'une année et les garde en cache ;
+    # les mois hors de la période sont retirés au moment de l'export
+    types_of_interest = [1, 2, 4]
+    echelles_of_interest = ["departement", "epci", "commune", "section"]
+    print("Starting with", year)
+    ventes = load_ventes([year])
+    types_bien = get_types_bien(year)
+    print("Après déduplication et filtre types et natures :", len(ventes))
+
+    ventes_nodup = ventes.loc[ventes["mono_bien"]]
+    print("Après filtrage des ventes de plusieurs biens :", len(ventes_nodup))
+
+    # pas de prix ou pas de surface
+    ventes_nodup = ventes_nodup.dropna(subset=["prix_m2"])
+
+    # garde fou pour les valeurs aberrantes
+    ventes_nodup = ventes_nodup.loc[ventes_nodup['prix_m2'] < 100000]
+    print("Après retrait des ventes sans prix au m² et valeurs aberrantes :", len(ventes_nodup))
+
+    month_range = range(1, 13)
+
+    # toutes les stats de l'année sont calculées en une passe par échelle,
+    # puis remises dans l'ordre mois > échelle > code
+    export = pd.concat(
         [
-            int(f.replace("full_", "").replace(".csv", ""))
-            for f in os.listdir(DATADIR)
-            if "full_" in f and ".gz" not in f
+            get_monthly_stats_echelle(ventes_nodup, echelle)
+            for echelle in echelles_of_interest
+        ] + [
+            get_monthly_stats_nation(
+                ventes, ventes_nodup, types_bien, types_of_interest, month_range
+            )
         ]
     )
-    export = {}
+    export = export.loc[export["month"].isin(month_range)]
+    export = export.sort_values("month", kind="mergesort")
+    export["annee_mois"] = export["month"].apply(
+        lambda m: f'{year}-{"0"+str(m) if m < 10 else m}'
+    )
+    export = export.drop("month", axis=1)
+    export.to_parquet(CACHEDIR + f"stats_dvf_{year}.parquet", index=False)
+    print("Done with", year)
+
+
+def process_dvf_stats(params):
+    years = get_dvf_years()
+    manifest = load_manifest()
+    # seules les années dont les ventes ont changé sont recalculées
+    to_compute = [
+        year for year in years
+        if manifest["stats"].get(str(year)) != manifest["ventes"][str(year)]
+        or not os.path.isfile(CACHEDIR + f"stats_dvf_{year}.parquet")
+    ]
+    print("Years to compute:", to_compute)
+    # les années sont indépendantes jusqu'à l'ajout des libellés, plus de workers
+    # réduisent la durée mais chacun charge une année en mémoire
+    nb_workers = int(params.get("nb_workers", 1))
+    if nb_workers > 1 and len(to_compute) > 1:
+        print(f"processing {len(to_compute)} years with {nb_workers} workers")
+        with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+            list(executor.map(get_stats_year, to_compute))
+    else:
+        for year in to_compute:
+            get_stats_year(year)
+    for year in to_compute:
+        manifest["stats"][str(year)] = manifest["ventes"][str(year)]
+    save_manifest(manifest)
+    # comme auparavant, les libellés des types de biens sont ceux de la dernière année
+    types_bien = get_types_bien(max(years))
+    types_of_interest = [1, 2, 4]
     epci = pd.read_csv(
         DATADIR + "/epci.csv",
         sep=",",
         encoding="utf8",
         dtype=str
     )
-    sections_from_dvf = set()
-    communes_from_dvf = set()
-    to_keep = [
-        "id_mutation",
-        "date_mutation",
-        "code_departement",
-        "code_commune",
-        "id_parcelle",
-        "nature_mutation",
-        "code_type_local",
-        "type_local",
-        "valeur_fonciere",
-        "surface_reelle_bati",
-    ]
-    natures_of_interest = [
-        "Vente",
-        "Vente en l'état futur d'achèvement",
-        "Adjudication",
-    ]
-    types_of_interest = [1, 2, 4]
-    echelles_of_interest = ["departement", "epci", "commune", "section"]
-    for year in years:
-        print("Starting with", year)
-        df_ = pd.read_csv(
-            DATADIR + f"/full_{year}.csv",
-            sep=",",
-            encoding="utf8",
-            dtype={
-                "code_commune": str,
-                "code_departement": str,
-            },
-            usecols=to_keep,
-        )
-        # les fichiers d'entrée contiennent entre 4 et 8% de doublons purs
-        df = df_.drop_duplicates()
-        # certaines communes ne sont pas dans des EPCI
-        df = pd.merge(
-            df,
-            epci[['code_commune', 'code_epci']],
-            on="code_commune",
-            how="left"
-        )
-        df["code_section"] = df["id_parcelle"].str[:10]
-        sections_from_dvf = sections_from_dvf | set(df['code_section'].unique())
-        communes_from_dvf = communes_from_dvf | set(df['code_commune'].unique())
-        df = df.drop("id_parcelle", axis=1)
-
-        types_bien = {
-            k: v
-            for k, v in df_[["code_type_local", "type_local"]]
-            .value_counts()
-            .to_dict()
-            .keys()
-        }
-        del df_
-
-        # types_bien = {
-        #     1: "Maison",
-        #     2: "Appartement",
-        #     3: "Dépendance",
-        #     4: "Local industriel. commercial ou assimilé",
-        #     NaN: terres (cf nature_culture)
-        # }
-
-        # filtres sur les ventes et les types de biens à considérer
-        # choix : les terres et/ou dépendances ne rendent pas une mutation
-        # multi-type
-        ventes = df.loc[
-            (df["nature_mutation"].isin(natures_of_interest)) &
-            (df["code_type_local"].isin(types_of_interest))
-        ]
-        del df
-        ventes["month"] = (
-            ventes["date_mutation"]
-            .apply(lambda x: int(x.split("-")[1]))
-        )
-        print("Après déduplication et filtre types et natures :", len(ventes))
-
-        # on ne garde que les ventes d'un seul bien
-        # cf historique pour les ventes multi-types
-        count_ventes = ventes['id_mutation'].value_counts().reset_index()
-        liste_ventes_monobien = count_ventes.loc[count_ventes['id_mutation'] == 1, 'index']
-        ventes_nodup = ventes.loc[ventes['id_mutation'].isin(liste_ventes_monobien)]
-        print("Après filtrage des ventes de plusieurs biens :", len(ventes_nodup))
-
-        ventes_nodup["prix_m2"] = (
-            ventes_nodup["valeur_fonciere"] /
-            ventes_nodup["surface_reelle_bati"]
-        )
-        ventes_nodup["prix_m2"] = ventes_nodup["prix_m2"].replace(
-            [np.inf, -np.inf], np.nan
-        )
-
-        # pas de prix ou pas de surface
-        ventes_nodup = ventes_nodup.dropna(subset=["prix_m2"])
-
-        # garde fou pour les valeurs aberrantes
-        ventes_nodup = ventes_nodup.loc[ventes_nodup['prix_m2'] < 100000]
-        print("Après retrait des ventes sans prix au m² et valeurs aberrantes :", len(ventes_nodup))
-        export_intermediary = []
-
-        # avoid unnecessary steps due to half years
-        month_range = range(1, 13)
-        if len(years) == 6:
-            if year == min(years):
-                month_range = range(7, 13)
-            elif year == max(years):
-                month_range = range(1, 7)
-
-        for m in month_range:
-            dfs_dict = {}
-            for echelle in echelles_of_interest:
-                grouped = ventes_nodup.groupby(
-                    [f"code_{echelle}", "month", "type_local"]
-                )["prix_m2"]
-
-                nb = grouped.count()
-                nb_ = (
-                    nb.loc[nb.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                nb_.columns = [
-                    "nb_ventes_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in nb_.columns
-                ]
-
-                mean = grouped.mean()
-                mean_ = (
-                    mean.loc[mean.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                mean_.columns = [
-                    "moy_prix_m2_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in mean_.columns
-                ]
-
-                median = grouped.median()
-                median_ = (
-                    median.loc[median.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                    .drop("month", axis=1)
-                )
-                median_.columns = [
-                    "med_prix_m2_" + unidecode(c.split(" ")[0].lower())
-                    if c != f"code_{echelle}"
-                    else c
-                    for c in median_.columns
-                ]
-
-                merged = pd.merge(nb_, mean_, on=[f"code_{echelle}"])
-                merged = pd.merge(merged, median_, on=[f"code_{echelle}"])
-
-                # appartement + maison
-                combined = ventes_nodup.loc[
-                    ventes_nodup["code_type_local"].isin([1, 2])
-                ].groupby(
-                    [f"code_{echelle}", "month"]
-                )["prix_m2"]
-
-                nb = combined.count()
-                nb_ = (
-                    nb.loc[nb.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                nb_.columns = [f'code_{echelle}', 'nb_ventes_apt_maison']
-
-                mean = combined.mean()
-                mean_ = (
-                    mean.loc[mean.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                mean_.columns = [f'code_{echelle}', 'moy_prix_m2_apt_maison']
-
-                median = combined.median()
-                median_ = (
-                    median.loc[median.index.get_level_values(1) == m]
-                    .unstack()
-                    .reset_index()
-                )
-                median_.columns = [f'code_{echelle}', 'med_prix_m2_apt_maison']
-
-                merged = pd.merge(merged, nb_, on=[f"code_{echelle}"], how="outer")
-                merged = pd.merge(merged, mean_, on=[f"code_{echelle}"])
-                merged = pd.merge(merged, median_, on=[f"code_{echelle}"])
-
-                for c in merged.columns:
-                    if any([k in c for k in ["moy_", "med_"]]):
-                        merged[c] = merged[c].round()
-
-                merged.rename(
-                    columns={f"code_{echelle}": "code_geo"},
-                    inplace=True
-                )
-                dfs_dict[echelle] = merged
-
-            general = {"code_geo": "nation"}
-            for t in types_of_interest:
-                general[
-                    "nb_ventes_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = len(
-                    ventes.loc[
-                        (ventes["code_type_local"] == t) &
-                        (ventes["month"] == m)
-                    ]
-                )
-                general[
-                    "moy_prix_m2_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = np.round(
-                    ventes_nodup.loc[
-                        (ventes_nodup["code_type_local"] == t) &
-                        (ventes_nodup["month"] == m)
-                    ]["prix_m2"].mean()
-                )
-                general[
-                    "med_prix_m2_" + unidecode(
-                        types_bien[t].split(" ")[0].lower()
-                    )
-                ] = np.round(
-                    ventes_nodup.loc[
-                        (ventes_nodup["code_type_local"] == t) &
-                        (ventes_nodup["month"] == m)
-                    ]["prix_m2"].median()
-                )
-
-            general["nb_ventes_apt_maison"] = len(
-                ventes.loc[
-                    (ventes["code_type_local"].isin([1, 2])) &
-                    (ventes["month"] == m)
-                ]
-            )
-            general["moy_prix_m2_apt_maison"] = np.round(
-                ventes_nodup.loc[
-                    (ventes_nodup["code_type_local"].isin([1, 2])) &
-                    (ventes_nodup["month"] == m)
-                ]["prix_m2"].mean()
-            )
-            general["med_prix_m2_apt_maison"] = np.round(
-                ventes_nodup.loc[
-                    (ventes_nodup["code_type_local"].isin([1, 2])) &
-                    (ventes_nodup["month"] == m)
-                ]["prix_m2"].median()
-            )
-
-            all_month = pd.concat(
-                list(dfs_dict.values()) + [pd.DataFrame([general])]
-            )
-            all_month["annee_mois"] = f'{year}-{"0"+str(m) if m < 10 else m}'
-            export_intermediary.append(all_month)
-            del all_month
-            del dfs_dict
-            del general
-        export[year] = pd.concat(export_intermediary)
-        del export_intermediary
-        del ventes
-        del ventes_nodup
-        gc.collect()
-        print("Done with", year)
+    codes_from_dvf = pd.concat([
+        pd.read_parquet(CACHEDIR + f"codes_{year}.parquet") for year in years
+    ])
+    sections_from_dvf = set(codes_from_dvf['code_section'].unique())
+    communes_from_dvf = set(codes_from_dvf['code_commune'].unique())
+    del codes_from_dvf
 
     # on ajoute les colonnes libelle_geo et code_parent
     with open(DATADIR + "/sections.txt", 'r') as f:
@@ -794,36 +1108,36 @@ def process_dvf_stats():
         [pref + lib for lib in libelles_biens for pref in prefixes] +\
         ['annee_mois', 'libelle_geo', 'code_parent', 'echelle_geo']
     print(reordered_columns)
+    # un seul libellé par couple (code_geo, code_parent), dans l'ordre des codes
+    libelles_parents = libelles_parents.sort_values(
+        ['code_geo', 'code_parent'], kind='mergesort'
+    ).reset_index(drop=True)
+    libelles_hash = hashlib.sha256(
+        pd.util.hash_pandas_object(libelles_parents, index=False).values.tobytes()
+    ).hexdigest()
     for year in years:
         print("Final process for " + str(year))
-        dup_libelle = libelles_parents.append(
-            [libelles_parents] * 11,
-            ignore_index=True
-        ).sort_values(['code_geo', 'code_parent'])
-        dup_libelle['annee_mois'] = [
+        months = [
             f'{year}-{"0"+str(m) if m < 10 else m}'
             for m in range(1, 13)
-        ] * len(libelles_parents)
-        dup_libelle.set_index(['code_geo', 'annee_mois'], inplace=True)
-        export[year] = export[year].join(
-            dup_libelle, on=['code_geo', 'annee_mois'],
-            how='outer'
-        )
+        ]
         if len(years) > 5 and year in [min(years), max(years)]:
-            export[year] = export[year].loc[
-                export[year]['annee_mois'].between(
-                    f'{min(years)}-07',
-                    f'{max(years)}-06'
-                )
+            months = [
+                m for m in months
+                if f'{min(years)}-07' <= m <= f'{max(years)}-06'
             ]
-        mask = export[year]['code_geo'] == 'nation'
-        export[year].loc[mask, ['code_parent', 'libelle_geo', 'echelle_geo']] = [
+        export = pd.read_parquet(CACHEDIR + f"stats_dvf_{year}.parquet")
+        export = export.loc[export['annee_mois'].isin(months)]
+        export = pd.merge(export, libelles_parents, on='code_geo', how='left')
+        mask = export['code_geo'] == 'nation'
+        export.loc[mask, ['code_parent', 'libelle_geo', 'echelle_geo']] = [
             ['-', 'nation', 'nation'] for k in range(sum(mask))
         ]
         del mask
-        export[year] = export[year][reordered_columns]
-        export[year].to_csv(
-            DATADIR + "/stats_dvf_api.csv",
+        export = export[reordered_columns]
+        # toutes les lignes ont au moins un nombre de ventes
+        export.to_csv(
+            DATADIR + "/stats_dvf.csv",
             sep=",",
             encoding="utf8",
             index=False,
@@ -831,178 +1145,182 @@ def process_dvf_stats():
             mode='w' if year == min(years) else 'a',
             header=True if year == min(years) else False
         )
-        print("Done with first export (API table)")
-
-        mask = export[year][[
-            c for c in export[year].columns if any([s in c for s in ['nb_', 'moy_', 'med_']])
-        ]]
-        mask = mask.isna().all(axis=1)
-        light_export = export[year].loc[~(mask)]
-        del mask
-
-        light_export.to_csv(
-            DATADIR + "/stats_dvf.csv",
+        # la table de l'API contient aussi les mois sans ventes de tous les codes,
+        # générés par morceaux à partir des libellés ; un fichier par année pour
+        # ne recharger en base que les années qui ont changé
+        api_file = DATADIR + f"/stats_dvf_api_{year}.csv"
+        export.to_csv(
+            api_file,
             sep=",",
             encoding="utf8",
             index=False,
             float_format="%.0f",
-            mode='w' if year == min(years) else 'a',
-            header=True if year == min(years) else False
         )
-        del export[year]
+        nb_rows = len(export)
+        for empty_months in iter_months_without_stats(libelles_parents, export, months):
+            empty_months.reindex(columns=reordered_columns).to_csv(
+                api_file,
+                sep=",",
+                encoding="utf8",
+                index=False,
+                float_format="%.0f",
+                mode='a',
+                header=False
+            )
+            nb_rows += len(empty_months)
+        manifest["stats_dvf_api"][str(year)] = {
+            "key": hashlib.sha256(
+                "|".join(
+                    [manifest["stats"][str(year)], libelles_hash] + months
+                ).encode()
+            ).hexdigest(),
+            "rows": nb_rows,
+        }
+        print("Done with API table")
+        del export
         print("Done with year " + str(year))
+    save_manifest(manifest)
+
+
+def iter_months_without_stats(libelles_parents, export, months, chunk_size=100000):
+    # lignes (code_geo, mois) des libellés absentes des stats, par code puis mois
+    with_stats = pd.MultiIndex.from_frame(export[['code_geo', 'annee_mois']])
+    codes = libelles_parents['code_geo'].to_numpy()
+    start = 0
+    while start < len(codes):
+        end = min(start + chunk_size, len(codes))
+        # les morceaux ne coupent pas les codes ayant plusieurs parents
+        while end < len(codes) and codes[end] == codes[end - 1]:
+            end += 1
+        chunk = pd.merge(
+            libelles_parents.iloc[start:end],
+            pd.DataFrame({'annee_mois': months}),
+            how='cross'
+        ).sort_values(['code_geo', 'annee_mois'], kind='mergesort')
+        missing = ~pd.MultiIndex.from_frame(
+            chunk[['code_geo', 'annee_mois']]
+        ).isin(with_stats)
+        yield chunk.loc[missing]
+        start = end
+
+
+def process_borne(borne, borne_inf, borne_sup):
+    # handle rounding of bounds
+    if round(borne, -2) <= borne_inf or round(borne, -2) >= borne_sup:
+        return round(borne)
+    else:
+        return round(borne, -2)
+
+
+def quantiles_by_group(values, starts, sizes, quantiles):
+    # équivalent de np.quantile (méthode linéaire) pour chaque tranche triée
+    # values[start:start + size], calculé pour toutes les tranches à la fois
+    virtual = (sizes[:, None] - 1) * quantiles[None, :]
+    gamma = virtual - np.floor(virtual)
+    above = virtual >= sizes[:, None] - 1
+    previous = np.where(above, sizes[:, None] - 1, np.floor(virtual)).astype(np.intp)
+    following = np.where(above, previous, previous + 1)
+    before = values[starts[:, None] + previous]
+    after = values[starts[:, None] + following]
+    diff = after - before
+    return np.where(gamma >= 0.5, after - diff * (1 - gamma), before + diff * gamma)
+
+
+def intervalles_from_quantiles(bins, prix_min, nb_tranches=10, arrondi=True):
+    # 1er et dernier quantiles gardés
+    # on coupe le reste des données en tranches égales de prix (!= volumes)
+    q = [[int(bins[k]), int(bins[k + 1])] for k in range(nb_tranches)]
+    size = (q[-1][0] - q[0][1]) / (nb_tranches - 2)
+    # to include the minimum price if it is equal to the lower bound, lower bound-1
+    inf = q[0][0] - 1 if prix_min == int(prix_min) else q[0][0]
+    # due to int, the upper bound is rounded down so +1 to include it
+    sup = q[-1][1] + 1
+    intervalles = [[inf, q[0][1]]] +\
+        [[q[0][1] + size * k, q[0][1] + size * (k + 1)]
+            for k in range(nb_tranches - 2)] +\
+        [[q[-1][0], sup]]
+    if arrondi:
+        # keep min and max values unchanged
+        borne_inf = intervalles[0][0]
+        borne_sup = intervalles[-1][1]
+        intervalles = [[borne_inf, process_borne(intervalles[0][1], borne_inf, borne_sup)]] + [
+            [process_borne(i[0], borne_inf, borne_sup), process_borne(i[1], borne_inf, borne_sup)]
+            for i in intervalles[1:-1]
+        ] + [[process_borne(intervalles[-1][0], borne_inf, borne_sup), borne_sup]]
+    bins = [i[0] for i in intervalles] + [intervalles[-1][1]]
+    # handle case where rounding creates identical bins
+    if len(bins) != len(set(bins)):
+        # check how many times bounds appear
+        count_bins = pd.Series(bins).value_counts().sort_index()
+        # get ranges between redundant bounds and next ones
+        ranges = [
+            (count_bins.index[k + 1] - count_bins.index[k]) / count_bins.values[k]
+            for k in range(len(count_bins) - 1)
+        ]
+        # create new bins from bounds and intervals
+        new_bins = [bins[0]]
+        for idx, b in enumerate(count_bins.values[:-1]):
+            for k in range(b):
+                new_bins.append(new_bins[-1] + ranges[idx])
+        bins = list(map(round, new_bins))
+    return intervalles, bins
+
+
+def distrib_by_code(codes, prix, threshold=100, nb_tranches=10, codes_geo=None):
+    # distributions des prix de tous les codes (restreints à codes_geo s'il est
+    # renseigné) ayant au moins threshold ventes : les prix sont triés une fois
+    # par code, puis les quantiles des prix uniques (pour éviter des bornes
+    # identiques) sont calculés pour tous les codes ensemble
+    if codes_geo is not None:
+        in_codes_geo = codes.isin(codes_geo)
+        codes, prix = codes[in_codes_geo], prix[in_codes_geo]
+    codes, labels = pd.factorize(codes)
+    prix = prix.to_numpy()[codes >= 0]
+    codes = codes[codes >= 0]
+    order = np.lexsort((prix, codes))
+    codes, prix = codes[order], prix[order]
+    new_code = np.r_[True, codes[1:] != codes[:-1]]
+    starts = np.flatnonzero(new_code)
+    ends = np.r_[starts[1:], len(codes)]
+    is_unique = new_code | np.r_[True, prix[1:] != prix[:-1]]
+    uniques = prix[is_unique]
+    unique_starts = np.cumsum(is_unique)[starts] - 1
+    quantiles = quantiles_by_group(
+        uniques,
+        unique_starts,
+        np.diff(np.r_[unique_starts, len(uniques)]),
+        np.array([k / nb_tranches for k in range(nb_tranches + 1)]),
+    )
+    distributions = {}
+    for g in np.flatnonzero(ends - starts >= threshold):
+        prix_code = prix[starts[g]:ends[g]]
+        intervalles, bins = intervalles_from_quantiles(quantiles[g], prix_code[0], nb_tranches)
+        if any(b >= next_b for b, next_b in zip(bins, bins[1:])):
+            raise ValueError("bins must increase monotonically.")
+        # volumes des tranches ]borne inférieure, borne supérieure], comme pd.cut
+        volumes = np.diff(np.searchsorted(prix_code, bins, side="right")).tolist()
+        distributions[labels[codes[starts[g]]]] = (intervalles, volumes)
+    return distributions
 
 
 def create_distribution_and_stats_whole_period():
-    def process_borne(borne, borne_inf, borne_sup):
-        # handle rounding of bounds
-        if round(borne, -2) <= borne_inf or round(borne, -2) >= borne_sup:
-            return round(borne)
-        else:
-            return round(borne, -2)
-
-    def distrib_from_prix(
-        prix,
-        nb_tranches=10,
-        arrondi=True
-    ):
-        # 1er et dernier quantiles gardés
-        # on coupe le reste des données en tranches égales de prix (!= volumes)
-        # .unique() pour éviter des bornes identique => ValueError
-        bins = np.quantile(prix.unique(), [k / nb_tranches for k in range(nb_tranches + 1)])
-        q = [[int(bins[k]), int(bins[k + 1])] for k in range(nb_tranches)]
-        size = (q[-1][0] - q[0][1]) / (nb_tranches - 2)
-        # to include the minimum price if it is equal to the lower bound, lower bound-1
-        inf = q[0][0] - 1 if min(prix) == int(min(prix)) else q[0][0]
-        # due to int, the upper bound is rounded down so +1 to include it
-        sup = q[-1][1] + 1
-        intervalles = [[inf, q[0][1]]] +\
-            [[q[0][1] + size * k, q[0][1] + size * (k + 1)]
-                for k in range(nb_tranches - 2)] +\
-            [[q[-1][0], sup]]
-        if arrondi:
-            # keep min and max values unchanged
-            borne_inf = intervalles[0][0]
-            borne_sup = intervalles[-1][1]
-            intervalles = [[borne_inf, process_borne(intervalles[0][1], borne_inf, borne_sup)]] + [
-                [process_borne(i[0], borne_inf, borne_sup), process_borne(i[1], borne_inf, borne_sup)]
-                for i in intervalles[1:-1]
-            ] + [[process_borne(intervalles[-1][0], borne_inf, borne_sup), borne_sup]]
-        bins = [i[0] for i in intervalles] + [intervalles[-1][1]]
-        # handle case where rounding creates identical bins
-        if len(bins) != len(set(bins)):
-            # check how many times bounds appear
-            count_bins = pd.Series(bins).value_counts().sort_index()
-            # get ranges between redundant bounds and next ones
-            ranges = [
-                (count_bins.index[k + 1] - count_bins.index[k]) / count_bins.values[k]
-                for k in range(len(count_bins) - 1)
-            ]
-            # create new bins from bounds and intervals
-            new_bins = [bins[0]]
-            for idx, b in enumerate(count_bins.values[:-1]):
-                for k in range(b):
-                    new_bins.append(new_bins[-1] + ranges[idx])
-            bins = list(map(round, new_bins))
-        volumes = pd.cut(
-            prix,
-            bins=bins
-        ).value_counts().sort_index().to_list()
-        return intervalles, volumes
-
     # on récupère toutes les échelles
-    echelles = pd.read_csv(
-        DATADIR + "/stats_dvf_api.csv",
-        sep=",",
-        encoding="utf8",
-        usecols=['code_geo', 'echelle_geo', 'code_parent', 'libelle_geo'],
-        dtype=str
-    )
-    echelles = echelles.drop_duplicates()
-    # on récupère les données DVF
-    years = sorted(
-        [
-            int(f.replace("full_", "").replace(".csv", ""))
-            for f in os.listdir(DATADIR)
-            if "full_" in f and ".gz" not in f
-        ]
-    )
-    dvf = []
-    epci = pd.read_csv(
-        DATADIR + "/epci.csv",
-        sep=",",
-        encoding="utf8",
-        dtype=str
-    )
-    to_keep = [
-        "id_mutation",
-        "code_departement",
-        "code_commune",
-        "id_parcelle",
-        "nature_mutation",
-        "code_type_local",
-        "type_local",
-        "valeur_fonciere",
-        "surface_reelle_bati",
-    ]
-    for year in years:
-        print("Starting with", year)
-        df_ = pd.read_csv(
-            DATADIR + f"/full_{year}.csv",
+    # les distributions et stats sur toute la période dépendent de toutes les
+    # années à la fois, elles sont recalculées entièrement à chaque run
+    echelles = pd.concat([
+        pd.read_csv(
+            file,
             sep=",",
             encoding="utf8",
-            dtype={
-                "code_commune": str,
-                "code_departement": str,
-            },
-            usecols=to_keep,
-        )
-        df = df_.drop_duplicates()
-        df["code_section"] = df["id_parcelle"].str[:10]
-        df = df.drop("id_parcelle", axis=1)
-
-        natures_of_interest = [
-            "Vente",
-            "Vente en l'état futur d'achèvement",
-            "Adjudication",
-        ]
-        del df_
-
-        # filtres sur les ventes et les types de biens à considérer
-        # choix : les terres et/ou dépendances ne rendent pas une mutation
-        # multitype
-        ventes = df.loc[
-            (df["nature_mutation"].isin(natures_of_interest)) &
-            (df["code_type_local"].isin([1, 2, 4]))
-        ]
-        del df
-
-        # on ne garde que les ventes d'un seul bien
-        # cf historique pour les ventes multi-types
-        count_ventes = ventes['id_mutation'].value_counts().reset_index()
-        liste_ventes_monobien = count_ventes.loc[count_ventes['id_mutation'] == 1, 'index']
-        ventes_nodup = ventes.loc[ventes['id_mutation'].isin(liste_ventes_monobien)]
-
-        ventes_nodup["prix_m2"] = (
-            ventes_nodup["valeur_fonciere"] /
-            ventes_nodup["surface_reelle_bati"]
-        )
-        ventes_nodup["prix_m2"] = ventes_nodup["prix_m2"].replace(
-            [np.inf, -np.inf], np.nan
-        )
-
-        # pas de prix ou pas de surface
-        ventes_nodup = ventes_nodup.dropna(subset=["prix_m2"])
-        dvf.append(ventes_nodup)
-        del ventes_nodup
-
-    dvf = pd.concat(dvf, ignore_index=True)
-    dvf = pd.merge(
-        dvf,
-        epci[['code_commune', 'code_epci']],
-        on="code_commune",
-        how="left"
-    )
+            usecols=['code_geo', 'echelle_geo', 'code_parent', 'libelle_geo'],
+            dtype=str
+        ).drop_duplicates()
+        for file in sorted(glob.glob(DATADIR + "/stats_dvf_api_*.csv"))
+    ])
+    echelles = echelles.drop_duplicates()
+    # on récupère les ventes d'un seul bien avec un prix au m²
+    dvf = load_ventes(get_dvf_years(), mono_bien=True)
+    dvf = dvf.dropna(subset=["prix_m2"])
     # bool is for distribution calculation
     echelles_of_interest = {
         "departement": True,
@@ -1025,7 +1343,11 @@ def create_distribution_and_stats_whole_period():
             dvf['code_type_local'].isin(types_of_interest[t])
         ].drop('code_type_local', axis=1)
         # échelle nationale
-        intervalles, volumes = distrib_from_prix(restr_type_dvf['prix_m2'])
+        intervalles, volumes = distrib_by_code(
+            pd.Series('nation', index=restr_type_dvf.index),
+            restr_type_dvf['prix_m2'],
+            threshold=0,
+        )['nation']
         tranches.append({
             'code_geo': 'nation',
             'type_local': t,
@@ -1042,53 +1364,37 @@ def create_distribution_and_stats_whole_period():
         for e in echelles_of_interest:
             print("Starting", e, t)
             # stats
-            grouped = restr_type_dvf[[f'code_{e}', 'prix_m2']].groupby(f'code_{e}')
-            nb = grouped.count().reset_index()
-            nb.columns = ['code_geo', f'nb_ventes_whole_{t}']
-            mean = grouped.mean().reset_index()
-            mean.columns = ['code_geo', f'moy_prix_m2_whole_{t}']
-            median = grouped.median().reset_index()
-            median.columns = ['code_geo', f'med_prix_m2_whole_{t}']
-            merged = pd.merge(nb, mean, on='code_geo')
-            merged = pd.merge(merged, median, on='code_geo')
+            merged = restr_type_dvf.groupby(
+                f'code_{e}', observed=True
+            )['prix_m2'].agg(['count', 'mean', 'median']).sort_index().reset_index()
+            merged.columns = [
+                'code_geo',
+                f'nb_ventes_whole_{t}',
+                f'moy_prix_m2_whole_{t}',
+                f'med_prix_m2_whole_{t}',
+            ]
             type_stats.append(merged)
             print("- Done with stats")
 
             # distribution
             if echelles_of_interest[e]:
-                codes_geo = set(echelles.loc[echelles['echelle_geo'] == e, 'code_geo'])
-                restr_dvf = restr_type_dvf[[f'code_{e}', 'prix_m2']].set_index(f'code_{e}')['prix_m2']
-                idx = set(restr_dvf.index)
-                operations = len(codes_geo)
-                for i, code in enumerate(codes_geo):
-                    if i % (operations // 10) == 0 and i > 0:
-                        print(round(i / operations * 100), '%')
-                    if code in idx:
-                        prix = restr_dvf.loc[code]
-                        if not isinstance(prix, pd.core.series.Series):
-                            prix = pd.Series(prix)
-                        if len(prix) >= threshold:
-                            intervalles, volumes = distrib_from_prix(prix)
-                            tranches.append({
-                                'code_geo': code,
-                                'type_local': t,
-                                'xaxis': intervalles,
-                                'yaxis': volumes
-                            })
-                        else:
-                            tranches.append({
-                                'code_geo': code,
-                                'type_local': t,
-                                'xaxis': None,
-                                'yaxis': None
-                            })
-                    else:
-                        tranches.append({
-                            'code_geo': code,
-                            'type_local': t,
-                            'xaxis': None,
-                            'yaxis': None
-                        })
+                codes_geo = set(
+                    echelles.loc[echelles['echelle_geo'] == e, 'code_geo'].dropna()
+                )
+                distributions = distrib_by_code(
+                    restr_type_dvf[f'code_{e}'],
+                    restr_type_dvf['prix_m2'],
+                    threshold,
+                    codes_geo=codes_geo,
+                )
+                for code in sorted(codes_geo):
+                    intervalles, volumes = distributions.get(code, (None, None))
+                    tranches.append({
+                        'code_geo': code,
+                        'type_local': t,
+                        'xaxis': intervalles,
+                        'yaxis': volumes
+                    })
                 print("- Done with distribution")
             else:
                 print("- No distribution")
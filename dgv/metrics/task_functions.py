@@ -1,15 +1,23 @@
 
 from airflow.hooks.base import BaseHook
 from airflow.models import Variable
+import aiohttp
+import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date, timedelta
+from functools import reduce
 import glob
+import json
+import numpy as np
 import os
 import pandas as pd
-import requests
+import re
 import tarfile
-from tqdm import tqdm
+from urllib.parse import urlencode
 
-from datagouvfr_data_pipelines.utils.datagouv import get_resource
+from datagouvfr_data_pipelines.utils.datagouv import DATAGOUV_URL
+from datagouvfr_data_pipelines.utils.download import download_file_if_modified
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 from datagouvfr_data_pipelines.utils.postgres import (
     copy_file,
@@ -23,11 +31,59 @@ from datagouvfr_data_pipelines.config import (
 )
 
 TMP_FOLDER = f"{AIRFLOW_DAG_TMP}metrics/"
+# kept between runs, unlike TMP_FOLDER which is cleaned at the start of the DAG
+CATALOG_CACHE_FOLDER = f"{AIRFLOW_DAG_TMP}metrics_catalogs/"
 DAG_FOLDER = "datagouvfr_data_pipelines/dgv/metrics/"
 conn = BaseHook.get_connection("POSTGRES_METRIC")
 DB_METRICS_SCHEMA = Variable.get("DB_METRICS_SCHEMA", "metric")
-tqdm.pandas(desc='pandas progress bar', mininterval=5)
+# number of processes parsing the log archives, one archive per process
+NB_LOG_WORKERS = int(Variable.get("METRICS_NB_LOG_WORKERS", 1))
 minio_infra = MinIOClient(bucket=MINIO_BUCKET_INFRA)
+LANGUAGES = ["fr", "en", "es"]
+OBJ_TYPES = ["resources-id", "resources-static", "datasets", "organizations", "reuses"]
+# classifies an item of a log line in a single match: each alternative captures
+# the slug in a group named after the type, in order of precedence (a resource
+# by id is also a dataset page, and any page may contain /resources/)
+URL_REGEX = re.compile(
+    f"/(?:{'|'.join(LANGUAGES)})/(?:"
+    "datasets/r/(?P<resources_id>[^/]*)"
+    "|datasets/(?P<datasets>[^/]*)"
+    "|reuses/(?P<reuses>[^/]*)"
+    "|organizations/(?P<organizations>[^/]*)"
+    ")"
+    "|(?P<resources_static>.*/resources/.*)"
+)
+# matches the lines containing at least one item that can be classified
+URL_REGEX_BYTES = re.compile(
+    f"/(?:(?:{'|'.join(LANGUAGES)})/(?:datasets|reuses|organizations)|resources)/".encode()
+)
+CATALOGS = {
+    "datasets": {
+        "resource_id": "f868cca6-8da1-4369-a78d-47463f19a9a3",
+        "columns": ["id", "slug", "organization_id"],
+    },
+    "organizations": {
+        "resource_id": "b7bbfedc-2448-4135-a6c7-104548d396e7",
+        "columns": ["id", "slug"],
+    },
+    "reuses": {
+        "resource_id": "970aafa0-3778-4d8b-b9d1-de937525e379",
+        "columns": ["id", "slug", "organization_id", "remote_url"],
+    },
+    "resources": {
+        "resource_id": "4babf5f2-6a9c-45b5-9144-ca5eae6a7a6d",
+        "columns": ["id", "url", "dataset.id", "dataset.organization_id"],
+    },
+}
+MATOMO_URL = "https://stats.data.gouv.fr/index.php"
+# kept between runs so that reruns do not fetch the same outlinks again
+MATOMO_CACHE_FOLDER = f"{AIRFLOW_DAG_TMP}metrics_matomo/"
+# number of pages whose outlinks are requested in one bulk request
+MATOMO_BULK_SIZE = 50
+MATOMO_CONCURRENCY = int(Variable.get("METRICS_MATOMO_CONCURRENCY", 5))
+MATOMO_MAX_RETRIES = 5
+# number of distinct slugs counted in memory for a type before being spilled to disk
+FOUND_MAX_CARDINALITY = int(Variable.get("METRICS_FOUND_MAX_CARDINALITY", 1000000))
 
 
 def create_metrics_tables():
@@ -80,34 +136,44 @@ def copy_log_to_processed_folder(ti):
 
 
 def download_catalog():
-    get_resource(
-        resource_id="f868cca6-8da1-4369-a78d-47463f19a9a3",
-        file_to_store={
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_datasets.csv",
-        }
-    )
-    get_resource(
-        resource_id="b7bbfedc-2448-4135-a6c7-104548d396e7",
-        file_to_store={
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_organizations.csv",
-        }
-    )
-    get_resource(
-        resource_id="970aafa0-3778-4d8b-b9d1-de937525e379",
-        file_to_store={
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_reuses.csv",
-        }
-    )
-    get_resource(
-        resource_id="4babf5f2-6a9c-45b5-9144-ca5eae6a7a6d",
-        file_to_store={
-            "dest_path": TMP_FOLDER,
-            "dest_name": "catalog_resources.csv",
-        }
-    )
+    # the catalogs are only downloaded when they have changed since the last run,
+    # and only the columns we need are kept, as parquet files
+    os.makedirs(CATALOG_CACHE_FOLDER, exist_ok=True)
+    for obj_type, catalog in CATALOGS.items():
+        validators_path = f"{CATALOG_CACHE_FOLDER}catalog_{obj_type}.json"
+        validators = None
+        if os.path.isfile(validators_path) and os.path.isfile(get_catalog_path(obj_type)):
+            with open(validators_path, "r") as f:
+                validators = json.load(f)
+        new_validators = download_file_if_modified(
+            {
+                "url": f"{DATAGOUV_URL}/fr/datasets/r/{catalog['resource_id']}",
+                "dest_path": TMP_FOLDER,
+                "dest_name": f"catalog_{obj_type}.csv",
+            },
+            validators,
+        )
+        if new_validators is None:
+            print(f"catalog {obj_type} has not changed, using cache")
+            continue
+        print(f"catalog {obj_type} downloaded")
+        pd.read_csv(
+            f"{TMP_FOLDER}catalog_{obj_type}.csv",
+            dtype=str,
+            sep=";",
+            usecols=catalog["columns"],
+        ).to_parquet(get_catalog_path(obj_type), index=False)
+        with open(validators_path, "w") as f:
+            json.dump(new_validators, f)
+        os.remove(f"{TMP_FOLDER}catalog_{obj_type}.csv")
+
+
+def get_catalog_path(obj_type):
+    return f"{CATALOG_CACHE_FOLDER}catalog_{obj_type}.parquet"
+
+
+def load_catalog(obj_type, columns=None):
+    return pd.read_parquet(get_catalog_path(obj_type), columns=columns)
 
 
 def remove_files_if_exists(folder):
@@ -119,105 +185,68 @@ def remove_files_if_exists(folder):
         os.remove(f)
 
 
-def get_dict(df, obj_property):
-    arr = {}
-    for index, row in df.iterrows():
-        if (
-            isinstance(row[obj_property], str)
-            and "static.data.gouv.fr" in row[obj_property]
-        ):
-            arr[row[obj_property]] = row["id"]
-        else:
-            arr[row[obj_property]] = row["id"]
-            arr[row["id"]] = row["id"]
-    return arr
+def get_lookup(df, obj_property):
+    """Build the Series resolving a slug (or url) or an id into the object's id
+
+    Each row maps its `obj_property` to its id, and its id to itself unless
+    `obj_property` is a static url. When a key appears several times, the
+    last row wins.
+    """
+    is_static = df[obj_property].str.contains("static.data.gouv.fr", regex=False, na=False)
+    row_order = np.arange(len(df)) * 2
+    lookup = pd.concat([
+        pd.DataFrame({"key": df[obj_property].values, "id": df["id"].values, "order": row_order}),
+        pd.DataFrame({"key": df["id"].values, "id": df["id"].values, "order": row_order + 1})[
+            ~is_static.values
+        ],
+    ])
+    lookup = lookup.loc[lookup["key"].notna()].sort_values("order", kind="stable")
+    lookup = lookup.drop_duplicates(subset="key", keep="last")
+    return lookup.set_index("key")["id"]
 
 
 def get_date(a_date):
     return datetime.strptime(a_date, "[%d/%b/%Y:%H:%M:%S.%f]").strftime("%Y-%m-%d")
 
 
-def search_pattern(patterns, value, type_object):
-    for pattern in patterns:
-        if pattern in value:
-            slug = value.replace(pattern, "").split("/")[0].replace(";", "")
-            return slug, True, type_object
-    return None, False, None
-
-
-def search_pattern_resource_static(pattern, value, type_object):
-    if pattern in value:
-        slug = f"https://static.data.gouv.fr{value}".replace(";", "")
-        return slug, True, type_object
-    return None, False, None
+def classify_item(item):
+    match = URL_REGEX.match(item)
+    if match is None:
+        return None, None
+    group = match.lastgroup
+    slug = match.group(group).replace(";", "")
+    if group == "resources_static":
+        slug = f"https://static.data.gouv.fr{slug}"
+    return slug, group.replace("_", "-")
 
 
 def get_info(parsed_line):
-    languages = ["fr", "en", "es"]
-    patterns_datasets = [f"/{lang}/datasets/" for lang in languages]
-    patterns_reuses = [f"/{lang}/reuses/" for lang in languages]
-    patterns_organizations = [f"/{lang}/organizations/" for lang in languages]
-    patterns_resources_id = [f"/{lang}/datasets/r/" for lang in languages]
-    pattern_resources_static = "/resources/"
-    slug_line = None
-    found = False
-
     if (
         "DATAGOUVFR_RGS~" in parsed_line
         and '"GET' in parsed_line
         and ('302' in parsed_line or '200' in parsed_line)
     ):
-        for item in parsed_line:
-            slug, found, detect = search_pattern(patterns_resources_id, item, "resources-id")
-            if not found:
-                slug, found, detect = search_pattern(patterns_datasets, item, "datasets")
-            if not found:
-                slug, found, detect = search_pattern(patterns_reuses, item, "reuses")
-            if not found:
-                slug, found, detect = search_pattern(patterns_organizations, item, "organizations")
-            if not found:
-                slug, found, detect = search_pattern_resource_static(
-                    pattern_resources_static,
-                    item,
-                    "resources-static"
-                )
+        # when several items of the line match, the last one is kept
+        for item in reversed(parsed_line):
+            slug, type_detect = classify_item(item)
             if slug:
-                slug_line = slug
-                type_detect = detect
-    if slug_line:
-        return slug_line, type_detect
-    else:
+                return slug, type_detect
+    return None, None
+
+
+def get_line_info(b_line):
+    # the lines without any item that could be classified
+    # are skipped without decoding and splitting them
+    if not URL_REGEX_BYTES.search(b_line):
         return None, None
+    return get_info(b_line.decode("utf-8").split())
 
 
-def save_list_obj_type(list_obj, obj_type):
-    file_object = open(f"{TMP_FOLDER}found/found_{obj_type}.csv", "a")
-    for item in list_obj:
-        file_object.write(f"{item['date']};{item['id']}\n")
-
-
-def save_list_obj(list_obj):
-    list_resources_id = []
-    list_resources_static = []
-    list_datasets = []
-    list_organizations = []
-    list_reuses = []
-    for obj in list_obj:
-        if obj["type"] == "resources-id":
-            list_resources_id.append(obj)
-        if obj["type"] == "resources-static":
-            list_resources_static.append(obj)
-        if obj["type"] == "datasets":
-            list_datasets.append(obj)
-        if obj["type"] == "organizations":
-            list_organizations.append(obj)
-        if obj["type"] == "reuses":
-            list_reuses.append(obj)
-    save_list_obj_type(list_resources_id, "resources-id")
-    save_list_obj_type(list_resources_static, "resources-static")
-    save_list_obj_type(list_datasets, "datasets")
-    save_list_obj_type(list_organizations, "organizations")
-    save_list_obj_type(list_reuses, "reuses")
+def save_found_counts(counts, obj_type, shard):
+    with open(f"{TMP_FOLDER}found/found_{obj_type}-{shard}.csv", "a") as file_object:
+        for (date_metric, slug), nb_visit in counts.items():
+            file_object.write(f"{date_metric};{slug};{nb_visit}\n")
+    counts.clear()
 
 
 def get_id(arr, list_obj):
@@ -236,22 +265,98 @@ def append_chunk(cpt, obj_type, arr, list_obj, log):
             fp.write(f"{d['id']},{d['date']}\n")
 
 
-def parse(lines, date):
-    list_obj = []
+def iter_log_lines(file_name):
+    # streams the lines of every member of the archive, so that
+    # a whole file of haproxy logs is never loaded in memory at once
+    with tarfile.open(file_name, "r:gz") as tar:
+        for log_file in tar:
+            log_data = tar.extractfile(log_file)
+            if log_data is None:
+                # not a regular file (directory, link...)
+                continue
+            for b_line in log_data:
+                yield b_line
+
+
+def parse(lines, date, shard):
+    # hits are counted in memory by (date, slug) for each type, and only
+    # spilled to the shard files when a type reaches FOUND_MAX_CARDINALITY
+    found_counts = {obj_type: Counter() for obj_type in OBJ_TYPES}
+    hits = Counter()
     for b_line in lines:
         try:
-            slug_line = None
-            parsed_line = b_line.decode("utf-8").split()
-            slug_line, type_detect = get_info(parsed_line)
+            slug_line, type_detect = get_line_info(b_line)
             if slug_line:
-                list_obj.append({"type": type_detect, "id": slug_line, "date": date})
-                if len(list_obj) == 10000:
-                    save_list_obj(list_obj)
-                    list_obj = []
+                counts = found_counts[type_detect]
+                counts[(date, slug_line)] += 1
+                hits[type_detect] += 1
+                if len(counts) >= FOUND_MAX_CARDINALITY:
+                    save_found_counts(counts, type_detect, shard)
         except:
             raise Exception(f"Sorry, pb with line: {b_line}")
 
-    save_list_obj(list_obj)
+    for obj_type, counts in found_counts.items():
+        save_found_counts(counts, obj_type, shard)
+    return hits
+
+
+def parse_log_file(file_name, date):
+    # each archive gets its own shard of found files, so that
+    # several archives can be parsed in parallel
+    shard = file_name.split("/")[-1].replace(".tar.gz", "")
+    print(f"parsing {shard}")
+    return parse(iter_log_lines(file_name), date, shard)
+
+
+def parse_log_files(log_dates):
+    to_parse = [
+        (file_name, datetime.strptime(log_date, '%d%m%Y').date().isoformat())
+        for log_date in log_dates
+        for file_name in glob.glob(f"{TMP_FOLDER}/*{log_date}*.tar.gz")
+    ]
+    if NB_LOG_WORKERS > 1 and len(to_parse) > 1:
+        print(f"parsing {len(to_parse)} files with {NB_LOG_WORKERS} workers")
+        with ProcessPoolExecutor(max_workers=NB_LOG_WORKERS) as executor:
+            partial_hits = list(executor.map(parse_log_file, *zip(*to_parse)))
+    else:
+        partial_hits = [parse_log_file(*args) for args in to_parse]
+    hits = reduce(lambda x, y: x + y, partial_hits, Counter())
+    print("hits found:", dict(hits))
+
+
+def get_found_counts(obj_type, log_date, slug_column):
+    # sums the partial counts of all the shards of the date
+    counts = Counter()
+    for shard in glob.glob(f"{TMP_FOLDER}found/found_{obj_type}-*{log_date}*.csv"):
+        with open(shard, "r") as f:
+            for line in f:
+                date_metric, slug, nb_visit = line.rstrip("\n").split(";")
+                counts[(date_metric, slug)] += int(nb_visit)
+    if not counts:
+        raise pd.errors.EmptyDataError(f"No {obj_type} found for {log_date}")
+    return pd.DataFrame(
+        [[date_metric, slug, nb_visit] for (date_metric, slug), nb_visit in counts.items()],
+        columns=["date_metric", slug_column, "nb_visit"],
+    )
+
+
+def aggregate_visits(log_date, obj_type, df_catalog, lookup, id_column, catalog_columns):
+    df = get_found_counts(obj_type, log_date, "slug")
+    df["id"] = df["slug"].map(lookup)
+    df = df.drop(columns=["slug"])
+    df = df.groupby(
+        ["date_metric", "id"],
+        as_index=False
+    ).sum().sort_values(
+        by=["nb_visit"],
+        ascending=False
+    )
+    df = pd.merge(df, df_catalog[["id"] + catalog_columns], on="id", how="left")
+    df = df.rename(columns={"id": id_column})
+    df[["date_metric", id_column] + catalog_columns + ["nb_visit"]].to_csv(
+        f"{TMP_FOLDER}outputs/{obj_type}-{log_date}.csv", index=False, header=False
+    )
+    return df
 
 
 def get_unique_dates(first_list, second_list):
@@ -280,163 +385,58 @@ def process_log(ti):
         )
 
     remove_files_if_exists("outputs")
+    remove_files_if_exists("found")
+    # catalogs and lookups are loaded once for all the dates
+    catalogs = {obj_type: load_catalog(obj_type) for obj_type in CATALOGS}
+    lookups = {
+        obj_type: get_lookup(catalogs[obj_type], "slug")
+        for obj_type in ["datasets", "organizations", "reuses"]
+    }
     # analyser toutes les dates différentes
     alldates = set(d.split("/")[-1].split("-")[2] for d in newlogs)
+    print("parse lines")
+    parse_log_files(alldates)
     for log_date in alldates:
-        remove_files_if_exists("found")
         print("---------------")
         print(log_date)
-        lines = []
-        for file_name in glob.glob(f"{TMP_FOLDER}/*{log_date}*.tar.gz"):
-            with tarfile.open(file_name, "r:gz") as tar:
-                for log_file in tar:
-                    log_data = tar.extractfile(log_file)
-                    lines += log_data.readlines()
-
-        print("haproxy loaded")
-        print("parse lines")
-        isoformat_log_date = datetime.strptime(log_date, '%d%m%Y').date().isoformat()
-        parse(lines, isoformat_log_date)
 
-        try:
-            print("---- datasets -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_datasets.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug", "organization_id"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_datasets.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
-            )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id", "organization_id"]], on="id", how="left")
-            df = df.rename(columns={"id": "dataset_id"})
-            df[["date_metric", "dataset_id", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/datasets-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data datasets")
-
-        try:
-            print("---- organizations -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_organizations.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_organizations.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
-            )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id"]], on="id", how="left")
-            df = df.rename(columns={"id": "organization_id"})
-            df[["date_metric", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/organizations-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data organizations")
-
-        try:
-            print("---- reuses -----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_reuses.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "slug", "organization_id"]
-            )
-            catalog_dict = get_dict(df_catalog, "slug")
-            df = pd.read_csv(
-                f"{TMP_FOLDER}found/found_reuses.csv",
-                sep=";",
-                dtype=str,
-                header=None
-            )
-            df["id"] = df[1].apply(
-                lambda x: catalog_dict[x] if x in catalog_dict else None
-            )
-            df = df.rename(columns={0: "date_metric"})
-            df = df.drop(columns=[1])
-            df["nb_visit"] = 1
-            df = df.groupby(
-                ["date_metric", "id"],
-                as_index=False
-            ).count().sort_values(
-                by=["nb_visit"],
-                ascending=False
-            )
-            df = pd.merge(df, df_catalog[["id", "organization_id"]], on="id", how="left")
-            df = df.rename(columns={"id": "reuse_id"})
-            df[["date_metric", "reuse_id", "organization_id", "nb_visit"]].to_csv(
-                f"{TMP_FOLDER}outputs/reuses-{log_date}.csv", index=False, header=False
-            )
-            all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
-        except pd.errors.EmptyDataError:
-            print("empty data reuses")
+        for obj_type, id_column, catalog_columns in [
+            ("datasets", "dataset_id", ["organization_id"]),
+            ("organizations", "organization_id", []),
+            ("reuses", "reuse_id", ["organization_id"]),
+        ]:
+            try:
+                print(f"---- {obj_type} -----")
+                df = aggregate_visits(
+                    log_date,
+                    obj_type,
+                    catalogs[obj_type],
+                    lookups[obj_type],
+                    id_column,
+                    catalog_columns,
+                )
+                all_dates_processed = get_unique_dates(all_dates_processed, list(df["date_metric"].unique()))
+            except pd.errors.EmptyDataError:
+                print(f"empty data {obj_type}")
 
         try:
             print("--- resources ----")
-            df_catalog = pd.read_csv(
-                f"{TMP_FOLDER}catalog_resources.csv",
-                dtype=str,
-                sep=";",
-                usecols=["id", "url", "dataset.id", "dataset.organization_id"]
-            )
-            res1 = pd.read_csv(f"{TMP_FOLDER}found/found_resources-id.csv", dtype=str, header=None, sep=";")
+            df_catalog = catalogs["resources"]
+            res1 = get_found_counts("resources-id", log_date, "id")
             # remove resource when static
-            res1 = res1.rename(columns={0: "date_metric", 1: "id"})
             res1 = pd.merge(res1, df_catalog[["id", "url"]], on="id", how="left")
-            res1["is_static"] = res1["url"].apply(
-                lambda x: True if "static.data.gouv.fr" in str(x) else False)
+            res1["is_static"] = res1["url"].str.contains("static.data.gouv.fr", regex=False, na=False)
             print("shape", res1.shape[0])
-            res1 = res1[res1["is_static"] == False]
-            res1 = res1[["date_metric", "id"]]
+            res1 = res1[~res1["is_static"]]
+            res1 = res1[["date_metric", "id", "nb_visit"]]
             print("shape", res1.shape[0])
 
-            res2 = pd.read_csv(f"{TMP_FOLDER}found/found_resources-static.csv",
-                               dtype=str, header=None, sep=";")
-            res2 = res2.rename(columns={0: "date_metric", 1: "url"})
+            res2 = get_found_counts("resources-static", log_date, "url")
             res2 = pd.merge(res2, df_catalog[["id", "url"]], on="url", how="left")
-            res2 = res2[res2["id"].notna()][["date_metric", "id"]]
+            res2 = res2[res2["id"].notna()][["date_metric", "id", "nb_visit"]]
 
             resources = pd.concat([res1, res2])
-            resources["nb_visit"] = 1
-            resources = resources.groupby(["date_metric", "id"], as_index=False).count().sort_values(
+            resources = resources.groupby(["date_metric", "id"], as_index=False).sum().sort_values(
                 by=["nb_visit"], ascending=False)
             resources = pd.merge(resources, df_catalog[["id", "dataset.id", "dataset.organization_id"]],
                                  on="id", how="left")
@@ -454,22 +454,94 @@ def process_log(ti):
     ti.xcom_push(key="all_dates_processed", value=all_dates_processed)
 
 
-def get_matomo_outlinks(model, slug, target, metric_date):
-    matomo_url = 'https://stats.data.gouv.fr/index.php'
-    params = {
-        "module": "API",
+def get_matomo_outlinks_query(model, slug, metric_date):
+    return {
         "method": "Actions.getOutlinks",
         "actionType": "url",
         "segment": f"actionUrl==https://www.data.gouv.fr/fr/{model}/{slug}/",
-        "format": "JSON",
-        "token_auth": "anonymous",
         "idSite": 109,
         "period": "day",
         "date": metric_date.isoformat()
     }
-    matomo_res = requests.get(matomo_url, params=params)
-    matomo_res.raise_for_status()
-    return sum(outlink['nb_hits'] for outlink in matomo_res.json() if outlink["label"] in target)
+
+
+async def fetch_matomo_bulk(session, semaphore, queries):
+    # several Actions.getOutlinks queries are sent at once through API.getBulkRequest
+    data = {
+        "module": "API",
+        "method": "API.getBulkRequest",
+        "format": "JSON",
+        "token_auth": "anonymous",
+    }
+    for k, query in enumerate(queries):
+        data[f"urls[{k}]"] = urlencode(query)
+    for attempt in range(MATOMO_MAX_RETRIES):
+        try:
+            async with semaphore:
+                async with session.post(MATOMO_URL, data=data, timeout=60) as r:
+                    r.raise_for_status()
+                    results = await r.json(content_type=None)
+            for result in results:
+                if isinstance(result, dict) and result.get("result") == "error":
+                    raise ValueError(f"Matomo error: {result.get('message')}")
+            return results
+        except (aiohttp.ClientError, asyncio.exceptions.TimeoutError) as e:
+            if attempt == MATOMO_MAX_RETRIES - 1:
+                raise
+            print(f"Matomo request failed ({e}), retrying")
+            await asyncio.sleep(2 ** attempt)
+
+
+async def fetch_matomo_outlinks(model, slugs, metric_date, cache):
+    semaphore = asyncio.Semaphore(MATOMO_CONCURRENCY)
+
+    async def fetch_batch(session, batch):
+        results = await fetch_matomo_bulk(
+            session,
+            semaphore,
+            [get_matomo_outlinks_query(model, slug, metric_date) for slug in batch],
+        )
+        for slug, outlinks in zip(batch, results):
+            cache[slug] = [
+                {"label": outlink["label"], "nb_hits": outlink["nb_hits"]}
+                for outlink in outlinks
+            ]
+
+    batches = [
+        slugs[k:k + MATOMO_BULK_SIZE]
+        for k in range(0, len(slugs), MATOMO_BULK_SIZE)
+    ]
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[fetch_batch(session, batch) for batch in batches])
+
+
+def get_matomo_outlinks(model, slugs, metric_date):
+    """Get the outlinks of the pages of the objects for the given day
+
+    Results are cached on disk by date, so that a rerun only fetches
+    the slugs that are missing.
+    """
+    os.makedirs(MATOMO_CACHE_FOLDER, exist_ok=True)
+    cache_path = f"{MATOMO_CACHE_FOLDER}{model}-{metric_date.isoformat()}.json"
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    # objects without a slug have no page, hence no outlinks
+    unique_slugs = {slug for slug in slugs if isinstance(slug, str)}
+    to_fetch = sorted(unique_slugs - set(cache))
+    print(f"{len(unique_slugs) - len(to_fetch)} {model} in cache, fetching {len(to_fetch)}")
+    try:
+        asyncio.run(fetch_matomo_outlinks(model, to_fetch, metric_date, cache))
+    finally:
+        # what has been fetched is saved even if some requests failed
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+    return cache
+
+
+def count_outlinks(outlinks, target):
+    return sum(outlink['nb_hits'] for outlink in outlinks if outlink["label"] in target)
 
 
 def sum_outlinks_by_orga(df_orga, df_outlinks, model):
@@ -487,26 +559,17 @@ def process_matomo():
     if not os.path.exists(f'{TMP_FOLDER}matomo-outputs/'):
         os.makedirs(f'{TMP_FOLDER}matomo-outputs/')
 
-    df_orga = pd.read_csv(
-        f"{TMP_FOLDER}catalog_organizations.csv",
-        dtype=str,
-        sep=";",
-        usecols=["id", "slug"]
-    )
+    df_orga = load_catalog("organizations", columns=["id", "slug"])
     df_orga = df_orga.rename(columns={"id": "organization_id"})
 
     # Which timespan to target?
     yesterday = date.today() - timedelta(days=1)
     for model in ['reuses']:  # datasets?
         print(f"get matamo outlinks for {model}")
-        df_catalog = pd.read_csv(
-            f"{TMP_FOLDER}catalog_{model}.csv",
-            dtype=str,
-            sep=";",
-            usecols=["id", "slug", "remote_url", "organization_id"]
-        )
-        df_catalog['outlinks'] = df_catalog.progress_apply(
-            lambda x: get_matomo_outlinks(model, x.slug, x.remote_url, yesterday), axis=1)
+        df_catalog = load_catalog(model, columns=["id", "slug", "remote_url", "organization_id"])
+        outlinks = get_matomo_outlinks(model, df_catalog["slug"].to_list(), yesterday)
+        df_catalog['outlinks'] = df_catalog.apply(
+            lambda x: count_outlinks(outlinks.get(x.slug, []), x.remote_url), axis=1)
         df_catalog['date_metric'] = yesterday.isoformat()
         df_catalog.to_csv(f'{TMP_FOLDER}matomo-outputs/{model}-outlinks.csv',
                           columns=['date_metric', 'id', 'organization_id', 'outlinks'], index=False,
@@ -542,24 +605,27 @@ def save_metrics_to_postgres(ti):
         },
     ]
     for obj in config:
-        for lf in glob.glob(f"{TMP_FOLDER}outputs/{obj['name']}-*"):
-            if "-id-" not in lf and "-static-" not in lf:
-                copy_file(
-                    PG_HOST=conn.host,
-                    PG_PORT=conn.port,
-                    PG_DB=conn.schema,
-                    PG_TABLE=f"{DB_METRICS_SCHEMA}.visits_{obj['name']}",
-                    PG_USER=conn.login,
-                    PG_PASSWORD=conn.password,
-                    list_files=[
-                        {
-                            "source_path": "/".join(lf.split("/")[:-1]) + "/",
-                            "source_name": lf.split("/")[-1],
-                            "column_order": obj["columns"],
-                        }
-                    ],
-                    has_header=False
-                )
+        list_files = [
+            {
+                "source_path": "/".join(lf.split("/")[:-1]) + "/",
+                "source_name": lf.split("/")[-1],
+                "column_order": obj["columns"],
+            }
+            for lf in glob.glob(f"{TMP_FOLDER}outputs/{obj['name']}-*")
+            if "-id-" not in lf and "-static-" not in lf
+        ]
+        if list_files:
+            # all the dates of a table are loaded in one transaction
+            copy_file(
+                PG_HOST=conn.host,
+                PG_PORT=conn.port,
+                PG_DB=conn.schema,
+                PG_TABLE=f"{DB_METRICS_SCHEMA}.visits_{obj['name']}",
+                PG_USER=conn.login,
+                PG_PASSWORD=conn.password,
+                list_files=list_files,
+                has_header=False
+            )
 
 
 def save_matomo_to_postgres():
@@ -574,7 +640,15 @@ def save_matomo_to_postgres():
         },
     ]
     for obj in config:
-        for lf in glob.glob(f"{TMP_FOLDER}matomo-outputs/{obj['name']}-*"):
+        list_files = [
+            {
+                "source_path": "/".join(lf.split("/")[:-1]) + "/",
+                "source_name": lf.split("/")[-1],
+                "column_order": obj["columns"],
+            }
+            for lf in glob.glob(f"{TMP_FOLDER}matomo-outputs/{obj['name']}-*")
+        ]
+        if list_files:
             copy_file(
                 PG_HOST=conn.host,
                 PG_PORT=conn.port,
@@ -582,13 +656,7 @@ def save_matomo_to_postgres():
                 PG_TABLE=f"{DB_METRICS_SCHEMA}.matomo_{obj['name']}",
                 PG_USER=conn.login,
                 PG_PASSWORD=conn.password,
-                list_files=[
-                    {
-                        "source_path": "/".join(lf.split("/")[:-1]) + "/",
-                        "source_name": lf.split("/")[-1],
-                        "column_order": obj["columns"],
-                    }
-                ],
+                list_files=list_files,
                 has_header=False
             )
 
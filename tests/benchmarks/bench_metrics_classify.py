@@ -0,0 +1,50 @@
+"""Micro-benchmark of the classification of the metrics log lines
+
+Compares the previous per-pattern cascade, run on every decoded line, with
+`get_line_info` as used by `parse`, on a synthetic day of logs where a quarter
+of the requests are for catalog pages or files. Each implementation is timed
+several times and its best run is kept. Run from the root of the repository:
+
+    python -m tests.benchmarks.bench_metrics_classify [nb_lines] [nb_runs]
+"""
+import sys
+import time
+
+from tests import bootstrap
+
+bootstrap.setup()
+
+from datagouvfr_data_pipelines.dgv.metrics.task_functions import get_line_info  # noqa: E402
+from datagouvfr_data_pipelines.tests.dgv.metrics import legacy  # noqa: E402
+from datagouvfr_data_pipelines.tests.dgv.metrics.logs import random_log_lines  # noqa: E402
+
+
+def classify_legacy(lines):
+    return [legacy.get_info(b_line.decode("utf-8").split()) for b_line in lines]
+
+
+def classify(lines):
+    return [get_line_info(b_line) for b_line in lines]
+
+
+def main(nb_lines, nb_runs):
+    lines = [line.encode() for line in random_log_lines(nb_lines)]
+    results = {}
+    speeds = {}
+    for name, func in [("legacy", classify_legacy), ("current", classify)]:
+        durations = []
+        for _ in range(nb_runs):
+            start = time.perf_counter()
+            results[name] = func(lines)
+            durations.append(time.perf_counter() - start)
+        speeds[name] = nb_lines / min(durations)
+        print(f"{name}: {speeds[name]:,.0f} lines/s")
+    print(f"x{speeds['current'] / speeds['legacy']:.1f}")
+    assert results["legacy"] == results["current"]
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
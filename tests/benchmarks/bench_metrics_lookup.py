@@ -0,0 +1,46 @@
+"""Benchmark of the resolution of the visited slugs into catalog ids
+
+Compares the previous `iterrows` dict and per-row lambda with `get_lookup`
+and `Series.map`. Run from the root of the repository:
+
+    python -m tests.benchmarks.bench_metrics_lookup [nb_objects] [nb_hits]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from tests import bootstrap
+
+bootstrap.setup()
+
+from datagouvfr_data_pipelines.dgv.metrics.task_functions import get_lookup  # noqa: E402
+from datagouvfr_data_pipelines.tests.dgv.metrics import legacy  # noqa: E402
+
+
+def main(nb_objects, nb_hits):
+    rng = np.random.default_rng(0)
+    catalog = pd.DataFrame({
+        "id": [f"id{i}" for i in range(nb_objects)],
+        "slug": [f"slug-{i}" for i in range(nb_objects)],
+    })
+    hits = pd.Series([f"slug-{i}" for i in rng.integers(0, 2 * nb_objects, nb_hits)])
+
+    start = time.perf_counter()
+    expected = legacy.resolve_ids(hits, legacy.get_dict(catalog, "slug"))
+    duration_legacy = time.perf_counter() - start
+    print(f"legacy: {duration_legacy:.2f}s")
+
+    start = time.perf_counter()
+    resolved = hits.map(get_lookup(catalog, "slug"))
+    duration = time.perf_counter() - start
+    print(f"current: {duration:.2f}s (x{duration_legacy / duration:.1f})")
+    assert resolved.fillna("").equals(expected.fillna(""))
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 50000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000000,
+    )
@@ -0,0 +1,170 @@
+"""Benchmark of the reading and cleaning of the files to consolidate
+
+Compares the previous reading (chardet on the whole file, python engine
+with sep=None, line breaks removed cell by cell) with `read_csv_resource`
+and `remove_line_breaks`, and lists the files that they read differently.
+By default, a synthetic corpus shaped like the IRVE resources is generated
+(utf-8 with and without BOM, latin-1 possibly only after the first lines,
+; and , separators, line breaks in values, malformed files). Timings depend
+a lot on the version of chardet (the reference numbers were taken with
+chardet 5.2). Run from the root of the repository:
+
+    python -m tests.benchmarks.bench_read_csv_resource [corpus_folder]
+"""
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import chardet
+import pandas as pd
+
+from tests import bootstrap
+
+bootstrap.setup()
+
+from datagouvfr_data_pipelines.utils.schema import (  # noqa: E402
+    read_csv_resource,
+    remove_line_breaks,
+)
+
+COLUMNS = [
+    "nom_amenageur", "siren_amenageur", "contact_amenageur", "nom_operateur", "contact_operateur",
+    "telephone_operateur", "nom_enseigne", "id_station_itinerance", "id_station_local", "nom_station",
+    "implantation_station", "adresse_station", "code_insee_commune", "coordonneesXY", "nbre_pdc",
+    "id_pdc_itinerance", "id_pdc_local", "puissance_nominale", "prise_type_ef", "prise_type_2",
+    "prise_type_combo_ccs", "prise_type_chademo", "prise_type_autre", "gratuit", "paiement_acte",
+    "paiement_cb", "paiement_autre", "tarification", "condition_acces", "reservation", "horaires",
+    "accessibilite_pmr", "restriction_gabarit", "station_deux_roues", "raccordement", "num_pdl",
+    "date_mise_en_service", "observations", "date_maj", "cable_t2_attache",
+]
+WORDS = [
+    "Électricité", "Société", "Mairie de Sète", "parking", "Rue de l'Église", "Accès libre",
+    "24/7", "Réservé aux clients", "Garçon", "Voirie", "true", "false", "22.0", "Hôtel",
+]
+MALFORMED_FILES = {
+    "empty.csv": b"",
+    "header_only.csv": b"a;b;c\n",
+    "missing_fields.csv": b"a;b;c\n1;2\n3;4;5\n",
+    "extra_fields.csv": b"a;b;c\n1;2;3;4\n3;4;5\n",
+    "quote_in_field.csv": b'a;b\n"x"y;2\n3;4\n',
+}
+
+
+def random_value(rng, column, ascii_only):
+    if column == "coordonneesXY":
+        return f"[{rng.uniform(-5, 9):.6f}, {rng.uniform(41, 51):.6f}]"
+    if column in ("nbre_pdc", "puissance_nominale"):
+        return str(rng.randint(1, 350))
+    value = rng.choice(WORDS)
+    if ascii_only:
+        value = value.encode("ascii", "replace").decode().replace("?", "e")
+    if column == "observations" and rng.random() < 0.02:
+        value += "\nligne 2\r"
+    if rng.random() < 0.01:
+        value += "; " + value
+    return value
+
+
+def generate_corpus(folder, nb_files=150, seed=25):
+    rng = random.Random(seed)
+    for k in range(nb_files):
+        nb_rows = int(min(15000, rng.lognormvariate(6.3, 1.2)))
+        encoding = rng.choices(["utf-8", "utf-8-sig", "latin-1", "latin-1-late"], [70, 10, 17, 3])[0]
+        buffer = io.StringIO()
+        writer = csv.writer(
+            buffer,
+            delimiter=";" if rng.random() < 0.6 else ",",
+            lineterminator="\r\n" if rng.random() < 0.3 else "\n",
+        )
+        writer.writerow(COLUMNS if rng.random() < 0.9 else [c + " " for c in COLUMNS])
+        for i in range(nb_rows):
+            # only the end of the file has accented characters
+            ascii_only = encoding == "latin-1-late" and i <= nb_rows * 0.8
+            writer.writerow([random_value(rng, c, ascii_only) for c in COLUMNS])
+        data = buffer.getvalue()
+        if k % 50 == 7:
+            data = data.replace("\n", "\n\n", 3)
+        with open(os.path.join(folder, f"{k:03d}.csv"), "wb") as f:
+            f.write(data.encode(
+                "latin-1" if encoding.startswith("latin-1") else encoding, errors="replace"
+            ))
+    for name, content in MALFORMED_FILES.items():
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(content)
+
+
+def read_csv_resource_legacy(file_path):
+    with open(file_path, "rb") as f:
+        encoding = chardet.detect(f.read()).get("encoding")
+    if encoding == "Windows-1254":
+        encoding = "iso-8859-1"
+    return pd.read_csv(
+        file_path,
+        sep=None,
+        engine="python",
+        dtype="str",
+        encoding=encoding,
+        na_filter=False,
+        keep_default_na=False,
+    )
+
+
+def remove_line_breaks_legacy(df_r):
+    for c in df_r.columns:
+        df_r[c] = df_r[c].apply(
+            lambda s: s.replace('\n', '').replace('\r', '') if isinstance(s, str) else s
+        )
+
+
+def read_corpus(folder, read, clean):
+    dataframes = {}
+    start = time.perf_counter()
+    for file_name in sorted(os.listdir(folder)):
+        try:
+            df_r = read(os.path.join(folder, file_name))
+        except Exception as e:
+            dataframes[file_name] = e
+            continue
+        df_r.columns = [c.replace(' ', '') for c in df_r.columns]
+        clean(df_r)
+        dataframes[file_name] = df_r
+    return dataframes, time.perf_counter() - start
+
+
+def compare(legacy, current):
+    for file_name, expected in legacy.items():
+        df_r = current[file_name]
+        if isinstance(expected, Exception) or isinstance(df_r, Exception):
+            print(f"{file_name}: legacy {expected!r:.60}, current {df_r!r:.60}")
+            continue
+        try:
+            # missing trailing fields are read as "" instead of None
+            pd.testing.assert_frame_equal(
+                expected.fillna(""), df_r, check_index_type=False
+            )
+        except AssertionError as e:
+            print(f"{file_name}: {str(e).splitlines()[0]}")
+
+
+def main(folder):
+    print(f"chardet {chardet.__version__}")
+    legacy, duration_legacy = read_corpus(
+        folder, read_csv_resource_legacy, remove_line_breaks_legacy
+    )
+    print(f"legacy: {duration_legacy:.1f}s")
+    current, duration = read_corpus(folder, read_csv_resource, remove_line_breaks)
+    print(f"current: {duration:.1f}s (x{duration_legacy / duration:.1f})")
+    compare(legacy, current)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            generate_corpus(folder)
+            main(folder)
@@ -0,0 +1,52 @@
+"""Make the task modules importable outside of a running Airflow instance
+
+Importing a task module reads Airflow connections and variables and
+creates MinIO clients, which all need the production infrastructure.
+They are replaced by harmless mocks: variables take their default value.
+"""
+import importlib.machinery
+import importlib.util
+import os
+import sys
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_patchers = []
+
+
+def register_package():
+    # the repository is cloned as the `datagouvfr_data_pipelines` package
+    # in the Airflow dags folder, the clone may have another name elsewhere
+    try:
+        import datagouvfr_data_pipelines  # noqa: F401
+    except ModuleNotFoundError:
+        spec = importlib.machinery.ModuleSpec(
+            "datagouvfr_data_pipelines", None, is_package=True
+        )
+        package = importlib.util.module_from_spec(spec)
+        package.__path__ = [REPO_ROOT]
+        sys.modules["datagouvfr_data_pipelines"] = package
+
+
+def setup():
+    if _patchers:
+        return
+    register_package()
+    _patchers.extend([
+        mock.patch("airflow.hooks.base.BaseHook.get_connection"),
+        mock.patch(
+            "airflow.models.Variable.get",
+            side_effect=lambda key, default_var=None, *args, **kwargs: default_var,
+        ),
+    ])
+    for patcher in _patchers:
+        patcher.start()
+    # MinIOClient checks that its bucket exists when instanciated
+    patcher = mock.patch("datagouvfr_data_pipelines.utils.minio.MinIOClient")
+    patcher.start()
+    _patchers.append(patcher)
+
+
+def teardown():
+    while _patchers:
+        _patchers.pop().stop()
@@ -0,0 +1,8 @@
+from tests import bootstrap
+
+# the test modules import the task modules at collection time
+bootstrap.setup()
+
+
+def pytest_unconfigure(config):
+    bootstrap.teardown()
@@ -0,0 +1,78 @@
+"""Previous implementation of the DVF price distributions, kept as reference"""
+import numpy as np
+import pandas as pd
+
+
+def process_borne(borne, borne_inf, borne_sup):
+    # handle rounding of bounds
+    if round(borne, -2) <= borne_inf or round(borne, -2) >= borne_sup:
+        return round(borne)
+    else:
+        return round(borne, -2)
+
+
+def distrib_from_prix(
+    prix,
+    nb_tranches=10,
+    arrondi=True
+):
+    # 1er et dernier quantiles gardés
+    # on coupe le reste des données en tranches égales de prix (!= volumes)
+    # .unique() pour éviter des bornes identique => ValueError
+    bins = np.quantile(prix.unique(), [k / nb_tranches for k in range(nb_tranches + 1)])
+    q = [[int(bins[k]), int(bins[k + 1])] for k in range(nb_tranches)]
+    size = (q[-1][0] - q[0][1]) / (nb_tranches - 2)
+    # to include the minimum price if it is equal to the lower bound, lower bound-1
+    inf = q[0][0] - 1 if min(prix) == int(min(prix)) else q[0][0]
+    # due to int, the upper bound is rounded down so +1 to include it
+    sup = q[-1][1] + 1
+    intervalles = [[inf, q[0][1]]] +\
+        [[q[0][1] + size * k, q[0][1] + size * (k + 1)]
+            for k in range(nb_tranches - 2)] +\
+        [[q[-1][0], sup]]
+    if arrondi:
+        # keep min and max values unchanged
+        borne_inf = intervalles[0][0]
+        borne_sup = intervalles[-1][1]
+        intervalles = [[borne_inf, process_borne(intervalles[0][1], borne_inf, borne_sup)]] + [
+            [process_borne(i[0], borne_inf, borne_sup), process_borne(i[1], borne_inf, borne_sup)]
+            for i in intervalles[1:-1]
+        ] + [[process_borne(intervalles[-1][0], borne_inf, borne_sup), borne_sup]]
+    bins = [i[0] for i in intervalles] + [intervalles[-1][1]]
+    # handle case where rounding creates identical bins
+    if len(bins) != len(set(bins)):
+        # check how many times bounds appear
+        count_bins = pd.Series(bins).value_counts().sort_index()
+        # get ranges between redundant bounds and next ones
+        ranges = [
+            (count_bins.index[k + 1] - count_bins.index[k]) / count_bins.values[k]
+            for k in range(len(count_bins) - 1)
+        ]
+        # create new bins from bounds and intervals
+        new_bins = [bins[0]]
+        for idx, b in enumerate(count_bins.values[:-1]):
+            for k in range(b):
+                new_bins.append(new_bins[-1] + ranges[idx])
+        bins = list(map(round, new_bins))
+    volumes = pd.cut(
+        prix,
+        bins=bins
+    ).value_counts().sort_index().to_list()
+    return intervalles, volumes
+
+
+def distributions_by_code(codes_geo, restr_dvf, threshold=100):
+    # boucle par code de create_distribution_and_stats_whole_period,
+    # restr_dvf étant la série des prix indexée par code
+    distributions = {}
+    idx = set(restr_dvf.index)
+    for code in codes_geo:
+        if code in idx:
+            prix = restr_dvf.loc[code]
+            if not isinstance(prix, pd.core.series.Series):
+                prix = pd.Series(prix)
+            if len(prix) >= threshold:
+                distributions[code] = distrib_from_prix(prix)
+                continue
+        distributions[code] = (None, None)
+    return distributions
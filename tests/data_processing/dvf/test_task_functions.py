@@ -0,0 +1,114 @@
+import io
+import tarfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datagouvfr_data_pipelines.data_processing.dvf import task_functions
+from datagouvfr_data_pipelines.data_processing.dvf.task_functions import (
+    distrib_by_code,
+    intervalles_from_quantiles,
+    process_dpe,
+)
+from datagouvfr_data_pipelines.tests.data_processing.dvf import legacy
+
+QUANTILES = [k / 10 for k in range(11)]
+
+
+def random_prix(kind, size, rng):
+    if kind == "lognormal":
+        return rng.lognormal(8, 1, size)
+    if kind == "integers":
+        return np.round(rng.lognormal(8, 1, size))
+    if kind == "ties":
+        # few distinct prices, each of them sold many times
+        return rng.choice([1000., 1500., 2250.5, 3000., 4000.], size)
+    if kind == "narrow":
+        # rounding the bounds to the hundred merges some bins
+        return rng.uniform(990, 1010, size)
+    return rng.uniform(0, 100000, size)
+
+
+KINDS = ["lognormal", "integers", "ties", "narrow", "uniform"]
+
+
+@pytest.mark.parametrize("arrondi", [True, False])
+@pytest.mark.parametrize("kind", KINDS)
+def test_intervalles_from_quantiles(kind, arrondi):
+    rng = np.random.default_rng(KINDS.index(kind))
+    for _ in range(20):
+        prix = pd.Series(random_prix(kind, 200, rng))
+        try:
+            expected, _ = legacy.distrib_from_prix(prix, arrondi=arrondi)
+        except ValueError:
+            # pd.cut rejected the bins, checked in test_distrib_by_code_invalid_bins
+            continue
+        intervalles, bins = intervalles_from_quantiles(
+            np.quantile(prix.unique(), QUANTILES), prix.min(), arrondi=arrondi
+        )
+        assert intervalles == expected
+        assert len(bins) == 11
+
+
+def test_intervalles_from_quantiles_merged_bins():
+    # bounds rounded to the same hundred are spread between their neighbours
+    prix = pd.Series([990.5 + k * 0.2 for k in range(100)])
+    expected = legacy.distrib_from_prix(prix)
+    intervalles, bins = intervalles_from_quantiles(
+        np.quantile(prix.unique(), QUANTILES), prix.min()
+    )
+    assert intervalles == expected[0]
+    assert len(set(bins)) == len(bins)
+    assert distrib_by_code(pd.Series("code", index=prix.index), prix, 0)["code"] == expected
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_distrib_by_code(kind):
+    rng = np.random.default_rng(KINDS.index(kind))
+    threshold = 100
+    codes, prix = [], []
+    # sizes around the threshold
+    for k, size in enumerate([1, 50, 99, 100, 101, 150, 500, 2000]):
+        codes += [f"{k:05d}"] * size
+        prix.append(random_prix(kind, size, rng))
+    dvf = pd.DataFrame({"code": codes, "prix": np.concatenate(prix)})
+    dvf = dvf.sample(frac=1, random_state=0)
+    # the last code is not part of the echelle, an unknown code is
+    codes_geo = set(dvf["code"]) - {"00007"} | {"99999"}
+
+    expected = legacy.distributions_by_code(
+        codes_geo, dvf.set_index("code")["prix"], threshold
+    )
+    distributions = distrib_by_code(dvf["code"], dvf["prix"], threshold, codes_geo=codes_geo)
+    assert set(distributions) == {"00003", "00004", "00005", "00006"}
+    assert {
+        code: distributions.get(code, (None, None)) for code in codes_geo
+    } == expected
+
+
+def test_distrib_by_code_invalid_bins():
+    # a single price gives identical bins, rejected by pd.cut as well
+    prix = pd.Series([2500.] * 150 + list(np.linspace(1000, 3000, 150)))
+    codes = pd.Series(["00001"] * 150 + ["00002"] * 150)
+    with pytest.raises(ValueError):
+        legacy.distrib_from_prix(prix[:150])
+    with pytest.raises(ValueError, match="bins must increase monotonically"):
+        distrib_by_code(codes, prix, 100)
+    # codes outside of codes_geo are not computed, and can not fail
+    distributions = distrib_by_code(codes, prix, 100, codes_geo={"00002"})
+    assert distributions == {"00002": legacy.distrib_from_prix(prix[150:])}
+
+
+def test_process_dpe_missing_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(task_functions, "CACHEDIR", f"{tmp_path}/")
+    monkeypatch.setattr(task_functions, "DATADIR", f"{tmp_path}/data")
+    monkeypatch.setattr(task_functions, "DPEDIR", f"{tmp_path}/data/dpe/")
+    # the archive only has the table of the parcelles
+    content = b"batiment_groupe_id,parcelle_id\nbat1,parcelle1\n"
+    with tarfile.open(tmp_path / "dpe.tar.gz", "w:gz") as tar:
+        member = tarfile.TarInfo("bdnb/rel_batiment_groupe_parcelle.csv")
+        member.size = len(content)
+        tar.addfile(member, io.BytesIO(content))
+    with pytest.raises(Exception, match="batiment_groupe_dpe_representatif_logement.csv not found"):
+        process_dpe()
@@ -0,0 +1,85 @@
+"""Previous implementations of the metrics helpers, kept as references"""
+
+
+def search_pattern(patterns, value, type_object):
+    for pattern in patterns:
+        if pattern in value:
+            slug = value.replace(pattern, "").split("/")[0].replace(";", "")
+            return slug, True, type_object
+    return None, False, None
+
+
+def search_pattern_resource_static(pattern, value, type_object):
+    if pattern in value:
+        slug = f"https://static.data.gouv.fr{value}".replace(";", "")
+        return slug, True, type_object
+    return None, False, None
+
+
+def get_info(parsed_line):
+    languages = ["fr", "en", "es"]
+    patterns_datasets = [f"/{lang}/datasets/" for lang in languages]
+    patterns_reuses = [f"/{lang}/reuses/" for lang in languages]
+    patterns_organizations = [f"/{lang}/organizations/" for lang in languages]
+    patterns_resources_id = [f"/{lang}/datasets/r/" for lang in languages]
+    pattern_resources_static = "/resources/"
+    slug_line = None
+    found = False
+
+    if (
+        "DATAGOUVFR_RGS~" in parsed_line
+        and '"GET' in parsed_line
+        and ('302' in parsed_line or '200' in parsed_line)
+    ):
+        for item in parsed_line:
+            slug, found, detect = search_pattern(patterns_resources_id, item, "resources-id")
+            if not found:
+                slug, found, detect = search_pattern(patterns_datasets, item, "datasets")
+            if not found:
+                slug, found, detect = search_pattern(patterns_reuses, item, "reuses")
+            if not found:
+                slug, found, detect = search_pattern(patterns_organizations, item, "organizations")
+            if not found:
+                slug, found, detect = search_pattern_resource_static(
+                    pattern_resources_static,
+                    item,
+                    "resources-static"
+                )
+            if slug:
+                slug_line = slug
+                type_detect = detect
+    if slug_line:
+        return slug_line, type_detect
+    else:
+        return None, None
+
+
+def get_dict(df, obj_property):
+    arr = {}
+    for index, row in df.iterrows():
+        if isinstance(row[obj_property], str) and "static.data.gouv.fr" in row[obj_property]:
+            arr[row[obj_property]] = row["id"]
+        else:
+            arr[row[obj_property]] = row["id"]
+            arr[row["id"]] = row["id"]
+    return arr
+
+
+def resolve_ids(slugs, catalog_dict):
+    return slugs.apply(lambda x: catalog_dict[x] if x in catalog_dict else None)
+
+
+def classify_item(item):
+    # the cascade of get_info, for a single item
+    languages = ["fr", "en", "es"]
+    for type_object, patterns in [
+        ("resources-id", [f"/{lang}/datasets/r/" for lang in languages]),
+        ("datasets", [f"/{lang}/datasets/" for lang in languages]),
+        ("reuses", [f"/{lang}/reuses/" for lang in languages]),
+        ("organizations", [f"/{lang}/organizations/" for lang in languages]),
+    ]:
+        slug, found, detect = search_pattern(patterns, item, type_object)
+        if found:
+            return slug, detect
+    slug, found, detect = search_pattern_resource_static("/resources/", item, "resources-static")
+    return slug, detect
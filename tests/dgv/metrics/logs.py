@@ -0,0 +1,61 @@
+"""Synthetic haproxy log lines, shaped like the ones parsed by the metrics DAG"""
+import random
+
+# pages and files of the catalog, counted by the metrics DAG
+CATALOG_PATHS = [
+    "/fr/datasets/{slug}/",
+    "/en/datasets/{slug}/",
+    "/es/datasets/{slug}/#resources",
+    "/fr/datasets/r/{uuid}",
+    "/es/datasets/r/{uuid};jsessionid=1",
+    "/fr/reuses/{slug}/",
+    "/fr/reuses/{slug}/?page=2",
+    "/en/organizations/{slug}/",
+    "/en/organizations/{slug}/datasets/",
+    "/resources/{slug}/20230101-000000/{uuid}.csv",
+    "/fr/datasets/",
+    "/fr/datasets/r/",
+]
+# most of the traffic: API calls, other pages of the site and assets
+OTHER_PATHS = [
+    "/api/1/datasets/{slug}/",
+    "/api/1/datasets/{slug}/resources/",
+    "/api/2/datasets/{slug}/resources/?page=1",
+    "/api/1/organizations/{slug}/",
+    "/api/1/reuses/?q=transport",
+    "/api/1/site/",
+    "/fr/",
+    "/fr/posts/",
+    "/_themes/gouvfr/js/app.js",
+    "/img/logo.svg",
+]
+CATALOG_SHARE = 0.25
+STATUSES = {"200": 70, "302": 10, "304": 10, "404": 8, "500": 2}
+METHODS = {'"GET': 90, '"POST': 7, '"HEAD': 3}
+FRONTENDS = {"DATAGOUVFR_RGS~": 90, "OTHER_FE": 10}
+
+
+def log_line(path, status="200", method='"GET', frontend="DATAGOUVFR_RGS~"):
+    return (
+        "<134>Jan  1 00:00:00 lb haproxy[123]: 1.2.3.4:5678 "
+        f"[01/Jan/2024:00:00:00.123] {frontend} backend/srv 0/0/0/10/10 {status} 1234 "
+        f"- - ---- 1/1/0/0/0 0/0 {method} {path} HTTP/1.1\"\n"
+    )
+
+
+def random_log_lines(nb_lines, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(nb_lines):
+        paths = CATALOG_PATHS if rng.random() < CATALOG_SHARE else OTHER_PATHS
+        path = rng.choice(paths).format(
+            slug=f"slug-{rng.randint(0, 3000)}",
+            uuid=f"{rng.randint(0, 5000):08x}",
+        )
+        lines.append(log_line(
+            path,
+            status=rng.choices(list(STATUSES), list(STATUSES.values()))[0],
+            method=rng.choices(list(METHODS), list(METHODS.values()))[0],
+            frontend=rng.choices(list(FRONTENDS), list(FRONTENDS.values()))[0],
+        ))
+    return lines
@@ -0,0 +1,209 @@
+from datetime import date
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datagouvfr_data_pipelines.dgv.metrics import task_functions
+from datagouvfr_data_pipelines.dgv.metrics.task_functions import (
+    URL_REGEX_BYTES,
+    classify_item,
+    get_info,
+    get_line_info,
+    get_lookup,
+    get_matomo_outlinks,
+)
+from datagouvfr_data_pipelines.tests.dgv.metrics import legacy
+from datagouvfr_data_pipelines.tests.dgv.metrics.logs import log_line, random_log_lines
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("/fr/datasets/my-dataset/", ("my-dataset", "datasets")),
+        ("/en/datasets/my-dataset/", ("my-dataset", "datasets")),
+        ("/es/datasets/my-dataset/#resources", ("my-dataset", "datasets")),
+        ("/fr/datasets/r/0a1b2c3d", ("0a1b2c3d", "resources-id")),
+        ("/es/datasets/r/0a1b2c3d;jsessionid=1", ("0a1b2c3djsessionid=1", "resources-id")),
+        ("/fr/reuses/my-reuse/?page=2", ("my-reuse", "reuses")),
+        ("/en/organizations/my-org/datasets/", ("my-org", "organizations")),
+        (
+            "/resources/my-dataset/20230101-000000/file.csv",
+            (
+                "https://static.data.gouv.fr/resources/my-dataset/20230101-000000/file.csv",
+                "resources-static",
+            ),
+        ),
+        # the slug is empty: the line is not counted
+        ("/fr/datasets/r/", (None, None)),
+        ("/api/1/datasets/my-dataset/", (None, None)),
+        ("/fr/posts/", (None, None)),
+    ],
+)
+def test_get_info(path, expected):
+    parsed_line = log_line(path).split()
+    assert get_info(parsed_line) == expected
+    assert get_info(parsed_line) == legacy.get_info(parsed_line)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"status": "404"},
+        {"status": "500"},
+        {"method": '"POST'},
+        {"method": '"HEAD'},
+        {"frontend": "OTHER_FE"},
+    ],
+)
+def test_get_info_ignored_lines(kwargs):
+    parsed_line = log_line("/fr/datasets/my-dataset/", **kwargs).split()
+    assert get_info(parsed_line) == (None, None)
+    assert legacy.get_info(parsed_line) == (None, None)
+
+
+def test_get_info_last_match_wins():
+    # several items of the line can match
+    parsed_line = log_line("/fr/datasets/my-dataset/").split()
+    parsed_line.append("/fr/reuses/my-reuse/")
+    assert get_info(parsed_line) == ("my-reuse", "reuses")
+    assert legacy.get_info(parsed_line) == ("my-reuse", "reuses")
+    # a match with an empty slug does not override a previous one
+    parsed_line.append("/fr/datasets/r/")
+    assert get_info(parsed_line) == ("my-reuse", "reuses")
+    assert legacy.get_info(parsed_line) == ("my-reuse", "reuses")
+
+
+def test_classify_item_precedence():
+    # a resource by id is also a dataset page, and a dataset
+    # page can contain /resources/ in its path
+    assert classify_item("/fr/datasets/r/abc") == ("abc", "resources-id")
+    assert classify_item("/fr/datasets/slug/resources/") == ("slug", "datasets")
+    assert classify_item("/fr/organizations/org/reuses/") == ("org", "organizations")
+    assert classify_item("/fr/reuses/reuse/organizations/") == ("reuse", "reuses")
+    assert classify_item("/fr/") == (None, None)
+
+
+@pytest.mark.parametrize(
+    "item",
+    [
+        "/fr/datasets/r/",
+        "/fr/datasets/rabc/",
+        "/fr/datasets/slug?page=2",
+        "/en/reuses/slug;jsessionid=1/",
+        "/es/organizations/",
+        "/api/1/datasets/slug/resources/",
+        "/api/2/datasets/slug/resources/?page=1",
+        "/resources/slug;x/file.csv",
+        "/fr/datasets",
+        "/de/datasets/slug/",
+        "HTTP/1.1\"",
+    ],
+)
+def test_classify_item_matches_legacy(item):
+    assert classify_item(item) == legacy.classify_item(item)
+
+
+def test_get_info_matches_legacy():
+    for line in random_log_lines(20000):
+        parsed_line = line.split()
+        expected = legacy.get_info(parsed_line)
+        assert get_info(parsed_line) == expected, line
+        assert get_line_info(line.encode()) == expected, line
+
+
+def test_url_regex_prefilter():
+    # the lines skipped by parse have no item that the cascade would classify
+    for line in random_log_lines(20000, seed=1):
+        if URL_REGEX_BYTES.search(line.encode()) is None:
+            for item in line.split():
+                assert classify_item(item) == (None, None), item
+                assert legacy.classify_item(item) == (None, None), item
+
+
+def assert_same_ids(catalog, slugs):
+    expected = legacy.resolve_ids(slugs, legacy.get_dict(catalog, "slug"))
+    resolved = slugs.map(get_lookup(catalog, "slug"))
+    assert resolved.isna().equals(expected.isna())
+    assert resolved.dropna().equals(expected.dropna())
+
+
+def test_get_lookup():
+    catalog = pd.DataFrame({
+        "id": ["id1", "id2", "id3", "id4", "id5", "id6"],
+        "slug": [
+            "slug-1",
+            # the slug of an object can be the id of another one
+            "id1",
+            "slug-3",
+            "https://static.data.gouv.fr/resources/slug-4/file.csv",
+            # duplicated slug: the last row wins
+            "slug-1",
+            np.nan,
+        ],
+    })
+    lookup = get_lookup(catalog, "slug")
+    assert lookup.to_dict() == {
+        "slug-1": "id5",
+        "id1": "id2",
+        "id2": "id2",
+        "slug-3": "id3",
+        "id3": "id3",
+        "https://static.data.gouv.fr/resources/slug-4/file.csv": "id4",
+        "id5": "id5",
+        "id6": "id6",
+    }
+    legacy_dict = legacy.get_dict(catalog, "slug")
+    # the null slug is not a key of the lookup
+    assert {k: v for k, v in legacy_dict.items() if isinstance(k, str)} == lookup.to_dict()
+
+    slugs = pd.Series([
+        "slug-1",
+        "id1",
+        "id4",
+        "https://static.data.gouv.fr/resources/slug-4/file.csv",
+        "unknown",
+        "id6",
+    ])
+    assert_same_ids(catalog, slugs)
+
+
+def test_get_lookup_matches_legacy():
+    rng = np.random.default_rng(0)
+    nb_objects = 2000
+    ids = [f"id{i}" for i in range(nb_objects)]
+    slugs = [f"slug-{i}" for i in rng.integers(0, nb_objects, nb_objects)]
+    # some objects are referenced by a static url or by another object's id
+    for i in rng.integers(0, nb_objects, 200):
+        slugs[i] = f"https://static.data.gouv.fr/resources/slug-{i}/file.csv"
+    for i in rng.integers(0, nb_objects, 100):
+        slugs[i] = ids[rng.integers(0, nb_objects)]
+    catalog = pd.DataFrame({"id": ids, "slug": slugs})
+    hits = pd.Series(
+        [f"slug-{i}" for i in rng.integers(0, 2 * nb_objects, 5000)]
+        + [f"id{i}" for i in rng.integers(0, 2 * nb_objects, 5000)]
+        + list(rng.choice(slugs, 5000))
+    )
+    assert_same_ids(catalog, hits)
+
+
+def test_get_matomo_outlinks_cache(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(task_functions, "MATOMO_CACHE_FOLDER", f"{tmp_path}/")
+    cached = {
+        "reuse-1": [{"label": "https://example.com", "nb_hits": 3}],
+        "reuse-2": [],
+    }
+    with open(tmp_path / "reuses-2024-01-01.json", "w") as f:
+        json.dump(cached, f)
+    fetched = []
+
+    async def fetch_matomo_outlinks(model, slugs, metric_date, cache):
+        fetched.extend(slugs)
+
+    monkeypatch.setattr(task_functions, "fetch_matomo_outlinks", fetch_matomo_outlinks)
+    # duplicated and null slugs are only counted once, and never fetched
+    slugs = ["reuse-1", "reuse-1", np.nan, "reuse-2", None, "reuse-3", "reuse-3"]
+    assert get_matomo_outlinks("reuses", slugs, date(2024, 1, 1)) == cached
+    assert fetched == ["reuse-3"]
+    assert "2 reuses in cache, fetching 1" in capsys.readouterr().out
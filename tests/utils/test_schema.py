@@ -0,0 +1,187 @@
+import asyncio
+import os
+import random
+from urllib.parse import urlparse
+
+import pandas as pd
+import pytest
+from aiohttp import web
+
+from datagouvfr_data_pipelines.utils import schema
+
+NB_RESOURCES = 30
+NB_VERSIONS = 5
+API_RATE = 20
+# the time between the sending of a request and its reception by the stub
+TOLERANCE = 0.01
+
+
+def is_valid(resource_nb, version_nb):
+    return (resource_nb + version_nb) % 3 != 0
+
+
+class Stub:
+    # local stand-in for the data.gouv.fr API and Validata, each on its own host:
+    # records when the requests are received and fails them according to `failures`
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.received = {"api": [], "validata": []}
+        self.runners = []
+        self.rng = random.Random(0)
+
+    def fail(self, kind, key):
+        statuses = self.failures.get((kind, key), [])
+        if statuses:
+            status, retry_after = statuses.pop(0)
+            return web.Response(status=status, headers={"Retry-After": retry_after})
+        return None
+
+    async def resource(self, request):
+        resource_id = request.match_info["resource_id"]
+        self.received["api"].append((asyncio.get_running_loop().time(), resource_id))
+        failure = self.fail("api", resource_id)
+        if failure:
+            return failure
+        return web.json_response({"id": resource_id, "filetype": "remote", "extras": {}})
+
+    async def validate(self, request):
+        rurl, schema_url = request.query["url"], request.query["schema"]
+        self.received["validata"].append((asyncio.get_running_loop().time(), rurl))
+        failure = self.fail("validata", rurl)
+        if failure:
+            return failure
+        # the reports do not come back in the order of the requests
+        await asyncio.sleep(self.rng.uniform(0, 0.02))
+        resource_nb = int(rurl.rsplit("/", 1)[-1].split(".")[0])
+        version_nb = int(schema_url.split("/")[-2])
+        return web.json_response({"report": {"valid": is_valid(resource_nb, version_nb)}})
+
+    async def serve(self, routes):
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        self.runners.append(runner)
+        return f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    async def start(self):
+        self.api_url = await self.serve(
+            [web.get("/api/1/datasets/{dataset_id}/resources/{resource_id}", self.resource)]
+        )
+        self.validata_url = await self.serve([web.get("/validate", self.validate)])
+        self.validata_base_url = self.validata_url + "/validate?schema={schema_url}&url={rurl}"
+
+    async def stop(self):
+        for runner in self.runners:
+            await runner.cleanup()
+
+
+def run_with_stub(stub, monkeypatch, coro_function):
+    async def main():
+        await stub.start()
+        monkeypatch.setattr(schema, "DATAGOUV_URL", stub.api_url)
+        monkeypatch.setattr(schema, "RATE_LIMITS", {
+            urlparse(stub.api_url).netloc: API_RATE,
+            urlparse(stub.validata_url).netloc: 1000,
+        })
+        try:
+            return await coro_function()
+        finally:
+            await stub.stop()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def empty_metadata(monkeypatch):
+    monkeypatch.setattr(schema, "resources_metadata", {})
+
+
+def ref_table():
+    return pd.DataFrame({
+        "dataset_id": [f"d{k % 7}" for k in range(NB_RESOURCES)],
+        "resource_id": [f"r{k}" for k in range(NB_RESOURCES)],
+        "resource_url": [f"http://files.example/{k}.csv" for k in range(NB_RESOURCES)],
+        "error_type": [None] * NB_RESOURCES,
+    })
+
+
+def test_validate_resources(monkeypatch, tmp_path):
+    # the first metadata request of some resources is throttled by the API
+    stub = Stub({("api", f"r{k}"): [(503, "0")] for k in range(0, NB_RESOURCES, 10)})
+    versions = [
+        (f"1.{v}", f"http://schemas.example/{v}/schema.json") for v in range(NB_VERSIONS)
+    ]
+    df = ref_table()
+
+    validity = run_with_stub(stub, monkeypatch, lambda: schema.validate_resources(
+        df, versions, "orga/schema", tmp_path, stub.validata_base_url
+    ))
+
+    # the results follow the order of the ref table, whatever the order of the responses
+    assert validity == {
+        f"1.{v}": [is_valid(k, v) for k in range(NB_RESOURCES)] for v in range(NB_VERSIONS)
+    }
+    # the metadata of each resource is retrieved once, plus the retried requests
+    api_ids = [resource_id for _, resource_id in stub.received["api"]]
+    assert len(api_ids) == NB_RESOURCES + 3
+    assert sorted(set(api_ids)) == sorted(df["resource_id"])
+    assert sorted(schema.resources_metadata) == sorted(df["resource_id"])
+    assert len(stub.received["validata"]) == NB_RESOURCES * NB_VERSIONS
+    assert len(os.listdir(tmp_path)) == NB_RESOURCES * NB_VERSIONS
+    # the requests to the API are spaced out according to its rate limit
+    times = sorted(t for t, _ in stub.received["api"])
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / API_RATE - TOLERANCE
+
+
+def get(stub, url):
+    async def request():
+        rate_limiter = schema.RateLimiter(schema.RATE_LIMITS, schema.DEFAULT_RATE_LIMIT)
+        async with schema.aiohttp.ClientSession() as session:
+            return await schema.get_with_retries(session, rate_limiter, stub.api_url + url)
+
+    return request
+
+
+def test_get_with_retries_retry_after(monkeypatch):
+    stub = Stub({("api", "r0"): [(429, "1"), (503, "0")]})
+
+    status, _ = run_with_stub(stub, monkeypatch, get(stub, "/api/1/datasets/d0/resources/r0"))
+
+    assert status == 200
+    times = [t for t, _ in stub.received["api"]]
+    assert len(times) == 3
+    # the delay asked by the API is waited for before retrying
+    assert times[1] - times[0] >= 1 - TOLERANCE
+
+
+def test_get_with_retries_exhausted(monkeypatch):
+    monkeypatch.setattr(schema, "MAX_RETRIES", 2)
+    stub = Stub({("api", "r0"): [(503, "0")] * 5})
+
+    status, _ = run_with_stub(stub, monkeypatch, get(stub, "/api/1/datasets/d0/resources/r0"))
+
+    assert status == 503
+    assert len(stub.received["api"]) == 3
+
+
+def test_rate_limiter():
+    async def main():
+        rate_limiter = schema.RateLimiter({"a.example": 50}, 1000)
+        loop = asyncio.get_running_loop()
+        times = {"a": [], "b": []}
+
+        async def request(host):
+            await rate_limiter.wait(f"http://{host}.example/path")
+            times[host].append(loop.time())
+
+        await asyncio.gather(*[request(host) for host in ["a", "b"] * 10])
+        return times
+
+    times = asyncio.run(main())
+    gaps = [b - a for a, b in zip(times["a"], times["a"][1:])]
+    assert min(gaps) >= 1 / 50 - TOLERANCE
+    # the other hosts are not slowed down by the limited one
+    assert times["b"][-1] - times["b"][0] < 9 / 50
@@ -1,6 +1,8 @@
 import requests
 from requests.auth import HTTPBasicAuth
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, TypedDict
+import os
 
 
 class Url(TypedDict):
@@ -9,33 +11,189 @@ class Url(TypedDict):
     dest_name: str
 
 
+class DownloadError(Exception):
+    """The downloaded content is not the one announced by the server"""
+
+
 def download_files(
     list_urls: List[Url],
     auth_user: Optional[str] = None,
     auth_password: Optional[str] = None,
-):
+    max_workers: int = 1,
+    resume: bool = False,
+    validators: Optional[dict] = None,
+    skip_not_found: bool = False,
+) -> dict:
     """Retrieve list of files from urls
 
     Args:
         list_urls (List[File]): List of Dictionnaries containing for each
         `url` `dest_path` and `dest_name` : url and the file properties chosen for destination ;
         `auth_user` and `auth_password` : Optional authentication ;
+        max_workers (int, optional): number of files downloaded at the same time. Defaults to 1.
+        resume (bool, optional): resume the interrupted downloads of a previous call
+        instead of starting them over, see download_file. Defaults to False.
+        validators (Optional[dict], optional): validators returned by a previous call,
+        by url: files that have not changed since are not downloaded again.
+        Defaults to None (unconditional downloads).
+        skip_not_found (bool, optional): skip urls returning a 404 instead of raising.
+        Defaults to False.
 
     Raises:
-        Exception: _description_
+        requests.HTTPError: If a file can't be retrieved
+
+    Returns:
+        dict: validators of each url, to be passed to the next call
+        (None for skipped urls)
     """
     if auth_user and auth_password:
         auth = HTTPBasicAuth(auth_user, auth_password)
     else:
         auth = None
+    validators = validators or {}
+
+    def download(url):
+        try:
+            new_validators = download_file(url, auth, resume, validators.get(url["url"]))
+        except requests.HTTPError as e:
+            if skip_not_found and e.response is not None and e.response.status_code == 404:
+                print(f"{url['url']} not found, skipped")
+                return url["url"], None
+            raise
+        if new_validators is None:
+            print(f"{url['dest_name']} not modified")
+            return url["url"], validators[url["url"]]
+        return url["url"], new_validators
+
+    if max_workers > 1 and len(list_urls) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(executor.map(download, list_urls))
+    return dict(map(download, list_urls))
+
+
+def download_file(
+    url: Url,
+    auth: Optional[HTTPBasicAuth] = None,
+    resume: bool = False,
+    validators: Optional[dict] = None,
+) -> Optional[dict]:
+    """Retrieve a file from its url
+
+    The file is written to `dest_name`.part, renamed once its size has been
+    checked against the one announced by the server: the destination is never
+    left incomplete. With `resume`, an existing .part file is completed with
+    a range request if the file has not changed on the server since.
+
+    Args:
+        url (Url): Dictionnary containing `url` `dest_path` and `dest_name` :
+        url and the file properties chosen for destination ;
+        auth (Optional[HTTPBasicAuth], optional): authentication. Defaults to None.
+        resume (bool, optional): resume an interrupted download. Defaults to False.
+        validators (Optional[dict], optional): `etag` and `last_modified` returned
+        by the previous call for this url. Defaults to None (unconditional download).
+
+    Raises:
+        DownloadError: If the downloaded file does not have the expected size
+
+    Returns:
+        Optional[dict]: the validators of the downloaded file, to be passed
+        to the next call, or None if the file has not been modified
+    """
+    dest = f"{url['dest_path']}{url['dest_name']}"
+    part = f"{dest}.part"
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    offset = 0
+    if (
+        resume
+        and os.path.isfile(part)
+        and os.path.getsize(part) > 0
+        and os.path.isfile(f"{part}.etag")
+    ):
+        with open(f"{part}.etag", "r") as f:
+            # the range is ignored by the server if the file has changed since
+            headers["If-Range"] = f.read()
+        offset = os.path.getsize(part)
+        headers["Range"] = f"bytes={offset}-"
+
+    with requests.get(url["url"], auth=auth, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        expected_size = write_response(r, part, offset)
+        new_validators = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
 
-    for url in list_urls:
-        with requests.get(
-            url["url"],
-            auth=auth,
-            stream=True,
-        ) as r:
-            r.raise_for_status()
-            with open(f"{url['dest_path']}{url['dest_name']}", "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+    size = os.path.getsize(part)
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(
+            f"{url['url']}: {size} bytes downloaded instead of {expected_size}"
+        )
+    os.replace(part, dest)
+    if os.path.isfile(f"{part}.etag"):
+        os.remove(f"{part}.etag")
+    return new_validators
+
+
+def write_response(r: requests.Response, part: str, offset: int) -> Optional[int]:
+    """Write the content of a response to a partial download file
+
+    Args:
+        r (requests.Response): streamed response
+        part (str): path of the partial download file
+        offset (int): size of the partial download file, which was requested as range
+
+    Raises:
+        DownloadError: If the server answered with another range than the requested one
+
+    Returns:
+        Optional[int]: expected size of the complete file, if known
+    """
+    if r.status_code == 206:
+        if not r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            raise DownloadError(f"{r.url}: unexpected range {r.headers.get('Content-Range')}")
+        print(f"Resuming {part} from {offset} bytes")
+        mode = "ab"
+        expected_size = int(r.headers["Content-Range"].split("/")[-1])
+    else:
+        mode = "wb"
+        expected_size = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+        # kept to resume the download if it is interrupted
+        if r.headers.get("ETag"):
+            with open(f"{part}.etag", "w") as f:
+                f.write(r.headers["ETag"])
+        elif os.path.isfile(f"{part}.etag"):
+            os.remove(f"{part}.etag")
+    if r.headers.get("Content-Encoding"):
+        # the announced size is the one of the encoded content
+        expected_size = None
+    with open(part, mode) as f:
+        # small chunks, so that little is lost if the connection is broken
+        for chunk in r.iter_content(chunk_size=65536):
+            f.write(chunk)
+    return expected_size
+
+
+def download_file_if_modified(
+    url: Url,
+    validators: Optional[dict] = None,
+) -> Optional[dict]:
+    """Retrieve a file from its url, unless it has not changed since the last download
+
+    Args:
+        url (Url): Dictionnary containing `url` `dest_path` and `dest_name` :
+        url and the file properties chosen for destination ;
+        validators (Optional[dict], optional): `etag` and `last_modified` returned
+        by the previous call for this url. Defaults to None (unconditional download).
+
+    Returns:
+        Optional[dict]: the validators of the downloaded file, to be passed
+        to the next call, or None if the file has not been modified
+    """
+    return download_file(url, validators=validators)
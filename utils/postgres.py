@@ -1,6 +1,20 @@
 import psycopg2
-from typing import List, TypedDict, Optional
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Literal, TypedDict, Optional
+from uuid import uuid4
+import gzip
+import io
 import os
+import re
+import time
+
+# maximum number of connections opened by a process for a given instance
+POOL_MAX_CONNECTIONS = 5
+# suffix of the tables (and of their indexes) loaded before replacing live ones
+STAGING_SUFFIX = "_staging"
+# pools are kept for the lifetime of the process, see get_pool
+pools = {}
 
 
 class File(TypedDict):
@@ -45,6 +59,106 @@ def get_conn(
     return conn
 
 
+def get_pool(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    PG_SCHEMA: Optional[str] = None,
+):
+    """Get the connection pool of the process for a postgres instance
+
+    Pools are keyed by (host, port, db, user, schema) and by process, so that
+    connections are never shared with forked processes.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+
+    Returns:
+        ThreadedConnectionPool: pool of connections to postgres instance
+    """
+    if not PG_SCHEMA:
+        PG_SCHEMA = "public"
+    key = (os.getpid(), PG_HOST, PG_PORT, PG_DB, PG_USER, PG_SCHEMA)
+    if key not in pools:
+        # idle connections are only kept up to minconn, extra ones are closed
+        # when given back to the pool
+        pools[key] = ThreadedConnectionPool(
+            minconn=1,
+            maxconn=POOL_MAX_CONNECTIONS,
+            host=PG_HOST,
+            database=PG_DB,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            port=PG_PORT,
+            options=f"-c search_path={PG_SCHEMA}"
+        )
+    return pools[key]
+
+
+@contextmanager
+def get_connection(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    PG_SCHEMA: Optional[str] = None,
+):
+    """Borrow a connection from the pool of a postgres instance
+
+    The transaction is committed when leaving the block, or rolled back
+    if an exception is raised, and the connection is given back to the pool.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+
+    Yields:
+        conn: Connection to postgres instance
+    """
+    pool = get_pool(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # broken connections are discarded instead of going back to the pool
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def server_side_cursor(conn, itersize: int = 10000):
+    """Open a named (server-side) cursor, to go through large results
+    without loading them entirely in memory
+
+    Args:
+        conn (Connection): connection to postgres instance, not in autocommit mode
+        itersize (int, optional): number of rows fetched from the server at a time
+        when iterating over the cursor. Defaults to 10000.
+
+    Yields:
+        cur: named cursor
+    """
+    with conn.cursor(name=f"cursor_{uuid4().hex}") as cur:
+        cur.itersize = itersize
+        yield cur
+
+
 def return_sql_results(cur):
     """Return data from a sql query
 
@@ -61,7 +175,7 @@ def return_sql_results(cur):
         data = None
     if data:
         columns = [desc[0] for desc in cur.description]
-        return [{k: v for k, v in zip(columns, d)} for d in data]
+        return format_rows(data, columns)
     else:
         return True
 
@@ -89,15 +203,76 @@ def execute_query(
         dict, bool: result of sql query or True if no result but
         correct execution
     """
-    conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        data = return_sql_results(cur)
-        conn.commit()
-        conn.close()
+    with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            data = return_sql_results(cur)
     return data
 
 
+def format_rows(rows: list, columns: List[str], output: Optional[str] = None):
+    """Format rows fetched from a cursor
+
+    Args:
+        rows (list): tuples fetched from the cursor
+        columns (List[str]): column names, in the order of the tuples
+        output (Optional[str], optional): "pandas" for a DataFrame, "arrow" for
+        a pyarrow Table. Defaults to None (list of dicts, like return_sql_results).
+
+    Returns:
+        list, pd.DataFrame or pa.Table: formatted rows
+    """
+    if output == "pandas":
+        import pandas as pd
+        return pd.DataFrame.from_records(rows, columns=columns)
+    if output == "arrow":
+        import pyarrow as pa
+        return pa.table(dict(zip(columns, map(list, zip(*rows)))))
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def iter_query(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    sql: str,
+    chunk_size: int = 10000,
+    output: Optional[Literal["pandas", "arrow"]] = None,
+    PG_SCHEMA: Optional[str] = None,
+) -> Iterator:
+    """Stream the result of a sql query to postgres instance by batches
+
+    Rows are fetched through a server-side cursor, so only one batch at a time
+    is held in memory, whatever the size of the result.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        sql (str): sql query to execute, must return rows (SELECT)
+        chunk_size (int, optional): number of rows per batch. Defaults to 10000.
+        output (Optional[str], optional): "pandas" to get DataFrames, "arrow" to get
+        pyarrow Tables. Defaults to None (lists of dicts).
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+
+    Yields:
+        list, pd.DataFrame or pa.Table: batches of at most chunk_size rows
+    """
+    with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with server_side_cursor(conn, itersize=chunk_size) as cur:
+            cur.execute(sql)
+            rows = cur.fetchmany(chunk_size)
+            # the description of a named cursor is only known after a first fetch
+            columns = [desc[0] for desc in cur.description]
+            while rows:
+                yield format_rows(rows, columns, output)
+                rows = cur.fetchmany(chunk_size)
+
+
 def execute_sql_file(
     PG_HOST: str,
     PG_PORT: str,
@@ -129,16 +304,13 @@ def execute_sql_file(
     for file in list_files:
         is_file = os.path.isfile(os.path.join(file["source_path"], file["source_name"]))
         if is_file:
-            conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-            with conn.cursor() as cur:
-                cur.execute(
-                    open(
+            with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+                with conn.cursor() as cur:
+                    with open(
                         os.path.join(file["source_path"], file["source_name"]), "r"
-                    ).read()
-                )
-                data = return_sql_results(cur)
-                conn.commit()
-                conn.close()
+                    ) as f:
+                        cur.execute(f.read())
+                    data = return_sql_results(cur)
         else:
             raise Exception(
                 f"file {file['source_path']}{file['source_name']} does not exists"
@@ -156,9 +328,13 @@ def copy_file(
     list_files: List[File],
     PG_SCHEMA: Optional[str] = None,
     has_header: Optional[bool] = True,
+    use_staging_table: Optional[bool] = False,
 ):
     """Copy raw data from local files to postgres instance
 
+    All files are loaded through a single connection and committed in a single
+    transaction, so that the table is never left partially loaded.
+
     Args:
         PG_HOST (str): host
         PG_PORT (str): port
@@ -166,44 +342,314 @@ def copy_file(
         PG_TABLE (str): table to upload data
         PG_USER (str): user
         PG_PASSWORD (str): password
-        list_files (List[File]): List of files containing raw data.
+        list_files (List[File]): List of files containing raw data, possibly gzipped (.gz).
         Local files are specified in a array of dictionnaries containing for each
         `source_path` and `source_name` : path of local sql file to execute.
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+        has_header (Optional[bool], optional): whether files have a header. Defaults to True.
+        use_staging_table (Optional[bool], optional): load the files into an UNLOGGED copy
+        of the table, indexed once loaded, which then replaces the table at commit.
+        Tables referenced by views or foreign keys can't be swapped. Defaults to False.
 
     Raises:
-        Exception: _description_
+        Exception: If one of the local file does not exist
 
     Returns:
-        _type_: _description_
+        dict, bool: result of sql query or True if no result but
+        correct execution
     """
-    for file_conf in list_files:
-        is_file = os.path.isfile(os.path.join(file_conf["source_path"], file_conf["source_name"]))
-        if is_file:
-            conn = get_conn(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA)
-            if "column_order" in file_conf and file_conf["column_order"] is not None:
-                COLUMNS = file_conf["column_order"]
-            else:
-                COLUMNS = ""
-            if has_header:
-                HEADER = "HEADER"
-            else:
-                HEADER = ""
-            file = open(
-                os.path.join(file_conf["source_path"], file_conf["source_name"]), "r"
-            )
-            with conn.cursor() as cur:
+    check_files(list_files)
+    target_table = f"{PG_TABLE}{STAGING_SUFFIX}" if use_staging_table else PG_TABLE
+    with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            if use_staging_table:
+                create_staging_table(cur, PG_TABLE)
+            copy_files_with_cursor(cur, target_table, list_files, has_header)
+            data = return_sql_results(cur)
+            if use_staging_table:
+                build_indexes(cur, PG_TABLE, target_table)
+                swap_tables(cur, PG_TABLE, target_table)
+    return data
+
+
+def copy_dataframes(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_TABLE: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    dataframes: Iterable,
+    PG_SCHEMA: Optional[str] = None,
+    use_staging_table: Optional[bool] = False,
+):
+    """Copy dataframes to postgres instance, without writing them to files
+
+    Dataframes are consumed one at a time, so a generator of chunks keeps memory
+    bounded. They are all loaded in a single transaction, like in copy_file.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_TABLE (str): table to upload data
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        dataframes (Iterable[pd.DataFrame]): dataframes whose columns are
+        columns of the table
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+        use_staging_table (Optional[bool], optional): as in copy_file. Defaults to False.
+
+    Returns:
+        int: number of rows copied
+    """
+    target_table = f"{PG_TABLE}{STAGING_SUFFIX}" if use_staging_table else PG_TABLE
+    nb_rows = 0
+    start = time.time()
+    with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            if use_staging_table:
+                create_staging_table(cur, PG_TABLE)
+            for df in dataframes:
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
                 cur.copy_expert(
                     sql=(
-                        f"COPY {PG_TABLE} {COLUMNS} FROM STDIN "
-                        f"WITH CSV {HEADER} DELIMITER AS ','"
+                        f"COPY {target_table} ({', '.join(df.columns)}) FROM STDIN "
+                        "WITH CSV DELIMITER AS ','"
                     ),
-                    file=file,
+                    file=buffer,
                 )
-                data = return_sql_results(cur)
-                conn.commit()
-                conn.close()
-        else:
+                nb_rows += cur.rowcount
+            duration = max(time.time() - start, 1e-6)
+            print(
+                f"{PG_TABLE}: {nb_rows} rows copied in "
+                f"{round(duration, 1)}s ({round(nb_rows / duration)} rows/s)"
+            )
+            if use_staging_table:
+                build_indexes(cur, PG_TABLE, target_table)
+                swap_tables(cur, PG_TABLE, target_table)
+    return nb_rows
+
+
+def create_staging_table(cur, table: str):
+    """Create an empty UNLOGGED copy of a table, named with STAGING_SUFFIX,
+    without its indexes: they are built once the data is loaded, which is much faster
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table to copy, possibly prefixed by its schema
+    """
+    cur.execute(
+        f"DROP TABLE IF EXISTS {table}{STAGING_SUFFIX};"
+        f"CREATE UNLOGGED TABLE {table}{STAGING_SUFFIX} "
+        f"(LIKE {table} INCLUDING ALL EXCLUDING INDEXES);"
+    )
+
+
+def check_files(list_files: List[File]):
+    """Check that local files exist
+
+    Args:
+        list_files (List[File]): files, as in copy_file
+
+    Raises:
+        Exception: If one of the local file does not exist
+    """
+    for file_conf in list_files:
+        if not os.path.isfile(os.path.join(file_conf["source_path"], file_conf["source_name"])):
             raise Exception(
                 f"file {file_conf['source_path']}{file_conf['source_name']} does not exists"
             )
-    return data
+
+
+def copy_files_with_cursor(cur, table: str, list_files: List[File], has_header: bool = True):
+    """Copy local files into a table, within the current transaction
+
+    Files ending with .gz are decompressed on the fly.
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table to upload data
+        list_files (List[File]): files, as in copy_file
+        has_header (bool, optional): whether files have a header. Defaults to True.
+    """
+    HEADER = "HEADER" if has_header else ""
+    for file_conf in list_files:
+        if "column_order" in file_conf and file_conf["column_order"] is not None:
+            COLUMNS = file_conf["column_order"]
+        else:
+            COLUMNS = ""
+        start = time.time()
+        open_file = gzip.open if file_conf["source_name"].endswith(".gz") else open
+        with open_file(
+            os.path.join(file_conf["source_path"], file_conf["source_name"]), "rt"
+        ) as file:
+            cur.copy_expert(
+                sql=(
+                    f"COPY {table} {COLUMNS} FROM STDIN "
+                    f"WITH CSV {HEADER} DELIMITER AS ','"
+                ),
+                file=file,
+            )
+        duration = max(time.time() - start, 1e-6)
+        print(
+            f"{file_conf['source_name']}: {cur.rowcount} rows copied in "
+            f"{round(duration, 1)}s ({round(cur.rowcount / duration)} rows/s)"
+        )
+
+
+def get_indexes(cur, table: str):
+    """List the indexes of a table, with the constraints they back
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table, possibly prefixed by its schema
+
+    Returns:
+        list: (index name, index definition, constraint definition or None) tuples
+    """
+    cur.execute(
+        "SELECT c.relname, pg_get_indexdef(i.indexrelid), pg_get_constraintdef(con.oid) "
+        "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "LEFT JOIN pg_constraint con "
+        "ON con.conindid = i.indexrelid AND con.conrelid = i.indrelid "
+        "WHERE i.indrelid = %s::regclass ORDER BY c.relname",
+        (table,),
+    )
+    return cur.fetchall()
+
+
+def build_indexes(cur, table: str, new_table: str, prefix: str = ""):
+    """Create on a table the indexes (and primary keys / unique constraints) of another one
+
+    The new indexes are named after the original ones, with the given prefix and
+    STAGING_SUFFIX, which swap_tables and replace_partition remove.
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table whose indexes are copied, possibly prefixed by its schema
+        new_table (str): table to index, possibly prefixed by its schema
+        prefix (str, optional): prefix of the names of the new indexes. Defaults to "".
+    """
+    for name, index_def, constraint_def in get_indexes(cur, table):
+        new_name = f"{prefix}{name}{STAGING_SUFFIX}"
+        start = time.time()
+        if constraint_def:
+            cur.execute(f"ALTER TABLE {new_table} ADD CONSTRAINT {new_name} {constraint_def}")
+        else:
+            cur.execute(re.sub(
+                r" INDEX \S+ ON (ONLY )?\S+ ",
+                f" INDEX {new_name} ON {new_table} ",
+                index_def,
+                count=1,
+            ))
+        print(f"{new_name} built in {round(time.time() - start, 1)}s")
+
+
+def rename_staging_indexes(cur, table: str):
+    """Remove STAGING_SUFFIX from the names of the indexes of a table
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table, possibly prefixed by its schema
+    """
+    schema_prefix = table.rsplit(".", 1)[0] + "." if "." in table else ""
+    for name, _, _ in get_indexes(cur, table):
+        if name.endswith(STAGING_SUFFIX):
+            cur.execute(
+                f"ALTER INDEX {schema_prefix}{name} RENAME TO {name[:-len(STAGING_SUFFIX)]}"
+            )
+
+
+def swap_tables(cur, table: str, new_table: str):
+    """Replace a table by another one, within the current transaction
+
+    The table is only locked from the swap to the end of the transaction,
+    readers keep using the previous version until then.
+
+    Args:
+        cur (Cursor): cursor from postgres connection
+        table (str): table to replace (created if it does not exist yet),
+        possibly prefixed by its schema
+        new_table (str): table replacing it, in the same schema
+    """
+    table_name = table.split(".")[-1]
+    cur.execute("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    persistence = cur.fetchone()
+    if persistence is None:
+        cur.execute(f"ALTER TABLE {new_table} RENAME TO {table_name};")
+    else:
+        if persistence[0] == "p":
+            # the replaced table was logged, so must be its replacement
+            cur.execute(f"ALTER TABLE {new_table} SET LOGGED")
+        cur.execute(
+            f"ALTER TABLE {table} RENAME TO {table_name}_old;"
+            f"ALTER TABLE {new_table} RENAME TO {table_name};"
+            f"DROP TABLE {table}_old;"
+        )
+    rename_staging_indexes(cur, table)
+
+
+def replace_partition(
+    PG_HOST: str,
+    PG_PORT: str,
+    PG_DB: str,
+    PG_TABLE: str,
+    PG_USER: str,
+    PG_PASSWORD: str,
+    partition: str,
+    column: str,
+    lower_bound: str,
+    upper_bound: str,
+    list_files: List[File],
+    PG_SCHEMA: Optional[str] = None,
+    has_header: Optional[bool] = True,
+):
+    """Load files into a new range partition of a table, replacing the previous one
+
+    The files are loaded into an UNLOGGED standalone table, indexed once loaded,
+    which is attached in place of the previous partition at the end of the
+    transaction: the partitioned table stays complete and indexed meanwhile.
+
+    Args:
+        PG_HOST (str): host
+        PG_PORT (str): port
+        PG_DB (str): db / schema
+        PG_TABLE (str): partitioned table, partitioned by range of `column`
+        PG_USER (str): user
+        PG_PASSWORD (str): password
+        partition (str): name of the partition, in the schema of the table
+        column (str): partition key
+        lower_bound (str): lower bound of the partition, included
+        upper_bound (str): upper bound of the partition, excluded
+        list_files (List[File]): files, as in copy_file
+        PG_SCHEMA (Optional[str], optional): schema. Defaults to None (public).
+        has_header (Optional[bool], optional): whether files have a header. Defaults to True.
+    """
+    check_files(list_files)
+    schema_prefix = PG_TABLE.rsplit(".", 1)[0] + "." if "." in PG_TABLE else ""
+    target_table = f"{schema_prefix}{partition}{STAGING_SUFFIX}"
+    with get_connection(PG_HOST, PG_PORT, PG_DB, PG_USER, PG_PASSWORD, PG_SCHEMA) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"DROP TABLE IF EXISTS {target_table};"
+                f"CREATE UNLOGGED TABLE {target_table} "
+                f"(LIKE {PG_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+                # spares the scan of the table when attaching it
+                f"ALTER TABLE {target_table} ADD CONSTRAINT {partition}_bounds "
+                f"CHECK ({column} IS NOT NULL AND {column} >= %s AND {column} < %s);",
+                (lower_bound, upper_bound),
+            )
+            copy_files_with_cursor(cur, target_table, list_files, has_header)
+            build_indexes(cur, PG_TABLE, target_table, prefix=f"{partition}_")
+            # the partitioned table is locked from here to the commit
+            cur.execute(
+                f"DROP TABLE IF EXISTS {schema_prefix}{partition};"
+                f"ALTER TABLE {target_table} RENAME TO {partition};"
+                f"ALTER TABLE {PG_TABLE} ATTACH PARTITION {schema_prefix}{partition} "
+                "FOR VALUES FROM (%s) TO (%s);",
+                (lower_bound, upper_bound),
+            )
+            rename_staging_indexes(cur, f"{schema_prefix}{partition}")
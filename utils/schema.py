@@ -1,3 +1,4 @@
+from datagouvfr_data_pipelines.config import AIRFLOW_DAG_TMP
 from datagouvfr_data_pipelines.utils.datagouv import (
     get_all_from_api_query,
     DATAGOUV_URL,
@@ -9,22 +10,30 @@ from datagouvfr_data_pipelines.utils.datagouv import (
 )
 from datagouvfr_data_pipelines.utils.minio import MinIOClient
 from datagouvfr_data_pipelines.utils.mattermost import send_message
+from datagouvfr_data_pipelines.utils.download import DownloadError, download_file
 from typing import List, Optional, Dict
 import pandas as pd
 import numpy as np
 import requests
+import aiohttp
+import asyncio
 import json
 from json import JSONDecodeError
+import codecs
+import csv
 import os
 import yaml
 from datetime import datetime, date
 import time
 from pathlib import Path
+from urllib.parse import urlparse
 import chardet
 import pickle
 import emails
 import shutil
 import pytz
+import threading
+from concurrent.futures import ThreadPoolExecutor
 pd.set_option('display.max_columns', None)
 
 # DEV : for local dev in order not to mess up with production
@@ -34,6 +43,23 @@ VALIDATA_BASE_URL = (
     "https://api.validata.etalab.studio/validate?schema={schema_url}&url={rurl}"
 )
 MINIMUM_VALID_RESOURCES_TO_CONSOLIDATE = 5
+# requests per second sent to each host when listing and validating the resources
+RATE_LIMITS = {
+    urlparse(VALIDATA_BASE_URL).netloc: 2,
+    urlparse(DATAGOUV_URL).netloc: 10,
+}
+DEFAULT_RATE_LIMIT = 5
+MAX_RETRIES = 3
+LISTING_MAX_CONCURRENCY = 10
+VALIDATION_MAX_CONCURRENCY = 10
+VALIDATION_TIMEOUT = 600
+RESOURCES_METADATA_FILE = "resources_metadata.json"
+# kept between the runs, so that unchanged files are not downloaded again
+SCHEMA_FILES_CACHE = f"{AIRFLOW_DAG_TMP}schema_files_cache/"
+DOWNLOAD_WORKERS = 8
+MAX_DOWNLOADS_PER_HOST = 4
+# bytes read to guess the encoding of the files to consolidate
+ENCODING_SAMPLE_SIZE = 20000
 api_url = f"{DATAGOUV_URL}/api/1/"
 schema_url_base = api_url + "datasets/?schema={schema_name}"
 tag_url_base = api_url + "datasets/?tag={tag}"
@@ -44,11 +70,40 @@ ignored_datasets = [
 ]
 forced_validation_day = date(2023, 12, 6)
 forced_validation = False
+# metadata of the resources (by id) retrieved from data.gouv.fr during the run,
+# shared by the listing, the validation and the update of the resources
+resources_metadata = {}
+# datasets (by id) listed during the run, so that a dataset found by several queries
+# is retrieved only once
+datasets_metadata = {}
 if datetime.today().date().month == forced_validation_day.month:
     if datetime.today().date().day == forced_validation_day.day:
         forced_validation = True
 
 
+# Resets the resources metadata cache to the one saved by the previous steps of the run, if any
+def load_resources_metadata(cache_path):
+    resources_metadata.clear()
+    cache_file = os.path.join(cache_path, RESOURCES_METADATA_FILE)
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            resources_metadata.update(json.load(f))
+
+
+def save_resources_metadata(cache_path):
+    with open(os.path.join(cache_path, RESOURCES_METADATA_FILE), "w") as f:
+        json.dump(resources_metadata, f)
+
+
+# Gets the metadata of a resource, only requesting the API if it has not been retrieved yet
+def get_resource_metadata(dataset_id, resource_id, api_url=api_url):
+    if resource_id not in resources_metadata:
+        r = requests.get(api_url + f"datasets/{dataset_id}/resources/{resource_id}/")
+        r.raise_for_status()
+        resources_metadata[resource_id] = r.json()
+    return resources_metadata[resource_id]
+
+
 def load_config(config_path):
     if os.path.exists(config_path):
         with open(config_path, "r") as infile:
@@ -167,30 +222,24 @@ def add_schema_default_config(
 # API parsing to get resources infos based on schema metadata, tags and search keywords
 def parse_api(url: str, api_url: str, schema_name: str) -> pd.DataFrame:
     fields = 'id,title,slug,page,organization,owner,'
-    fields += 'resources{schema,url,id,title,last_modified,created_at,'
-    fields += 'extras{check:headers:content-type,check:available}}'
+    # the whole extras and the filetype are kept in the resources metadata cache for the validation
+    fields += 'resources{schema,url,id,title,last_modified,created_at,filetype,extras}'
     all_datasets = get_all_from_api_query(
         url,
         mask=f"data{{{fields}}}" if 'api/2' not in url else None
     )
     # when using api/2, the resources are not directly accessible, so we use api/1 to get them
     if 'api/2' in url:
-        session = requests.Session()
-        session.headers.update({'X-fields': fields})
-        tmp = []
-        for d in all_datasets:
-            r = session.get(
-                api_url + "datasets/" + d["id"]
-            )
-            r.raise_for_status()
-            tmp.append(r.json())
-        session.close()
-        all_datasets = tmp
+        dataset_ids = [d["id"] for d in all_datasets]
+        asyncio.run(fetch_datasets(dataset_ids, api_url, fields))
+        all_datasets = [datasets_metadata[dataset_id] for dataset_id in dataset_ids]
     arr = []
     for dataset in all_datasets:
+        datasets_metadata[dataset["id"]] = dataset
         if dataset["id"] in ignored_datasets:
             continue
         for res in dataset["resources"]:
+            resources_metadata[res["id"]] = res
             if "format=csv" in res["url"]:
                 filename = res["url"].split("/")[-3] + ".csv"
             else:
@@ -240,13 +289,81 @@ def parse_api(url: str, api_url: str, schema_name: str) -> pd.DataFrame:
     return df
 
 
-# Make the validation report based on the resource url, the resource API-url,
-# the schema url and validation url
-def make_validata_report(rurl, schema_url, resource_api_url, validata_base_url=VALIDATA_BASE_URL):
-    # saves time by not pinging Validata for unchanged resources
-    data = requests.get(resource_api_url)
-    data.raise_for_status()
-    data = data.json()
+# Gets the datasets from api/1 (with the `fields` mask), concurrently,
+# except for the ones already listed during the run
+async def fetch_datasets(dataset_ids, api_url, fields):
+    rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+    semaphore = asyncio.Semaphore(LISTING_MAX_CONCURRENCY)
+
+    async def fetch(dataset_id):
+        async with semaphore:
+            dataset_url = api_url + "datasets/" + dataset_id
+            status, text = await get_with_retries(
+                session, rate_limiter, dataset_url, headers={'X-fields': fields}
+            )
+            if status >= 400:
+                raise requests.HTTPError(f"{status} Error for url: {dataset_url}")
+            datasets_metadata[dataset_id] = json.loads(text)
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=LISTING_MAX_CONCURRENCY),
+    ) as session:
+        await asyncio.gather(*[
+            fetch(dataset_id)
+            for dataset_id in set(dataset_ids)
+            if dataset_id not in datasets_metadata
+        ])
+
+
+class RateLimiter:
+    # spaces out the requests sent to each host (at most `rate` per second),
+    # whatever the number of tasks running concurrently
+    def __init__(self, rates: Dict[str, float], default_rate: float):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.next_slots = {}
+
+    async def wait(self, url: str):
+        host = urlparse(url).netloc
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slots.get(host, now))
+        self.next_slots[host] = slot + 1 / self.rates.get(host, self.default_rate)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# GET request retried on network errors, 429 and 5xx, returns the status and the body
+async def get_with_retries(session, rate_limiter, url, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        await rate_limiter.wait(url)
+        try:
+            async with session.get(url, **kwargs) as r:
+                text = await r.text()
+                if (r.status != 429 and r.status < 500) or attempt == MAX_RETRIES:
+                    return r.status, text
+                retry_after = r.headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+                print(f"Got {r.status} for {url}, retrying in {delay}s")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = 2 ** attempt
+            print(f"Got {e!r} for {url}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+
+async def get_validata_report(session, rate_limiter, rurl, schema_url, validata_base_url):
+    _, text = await get_with_retries(
+        session,
+        rate_limiter,
+        validata_base_url.format(schema_url=schema_url, rurl=rurl),
+    )
+    return json.loads(text)
+
+
+# Returns the validation report of a resource that has not changed since its last validation,
+# or None if the resource has to be validated
+def get_report_from_metadata(data, resource_api_url):
     # if resource is a file on data.gouv.fr (not remote, due to hydra async work)
     # as of today (2023-09-04), hydra processes a check every week and we want a consolidation every day,
     # this condition should be removed when hydra and consolidation follow the same schedule (every day).
@@ -262,15 +379,11 @@ def make_validata_report(rurl, schema_url, resource_api_url, validata_base_url=V
         # once a year we force scan every file, to compensate for potential anomalies
         if forced_validation:
             print(f"forced validation for {resource_api_url}")
-            r = requests.get(validata_base_url.format(schema_url=schema_url, rurl=rurl))
-            time.sleep(0.5)
-            return r.json()
+            return None
         # check if resource has never been validated
         if "validation-report:validation_date" not in extras:
             print(f"no validation yet: validation for {resource_api_url}")
-            r = requests.get(validata_base_url.format(schema_url=schema_url, rurl=rurl))
-            time.sleep(0.5)
-            return r.json()
+            return None
         # if it has, check whether hydra has detected a change since last validation
         elif extras.get("analysis:last-modified-at", False):
             last_modification_date = datetime.fromisoformat(extras["analysis:last-modified-at"])
@@ -281,9 +394,7 @@ def make_validata_report(rurl, schema_url, resource_api_url, validata_base_url=V
             if last_modification_date > last_validation_date:
                 print(f"recent hydra check: validation for {resource_api_url}")
                 # resource has been changed since last validation: validate again
-                r = requests.get(validata_base_url.format(schema_url=schema_url, rurl=rurl))
-                time.sleep(0.5)
-                return r.json()
+                return None
             else:
                 # resource has not changed since last validation, validation report from metadata
                 # NB: only recreating the keys required for downstream processes
@@ -311,15 +422,54 @@ def make_validata_report(rurl, schema_url, resource_api_url, validata_base_url=V
             }
     else:
         print(f"remote resource: validation for {resource_api_url}")
-        r = requests.get(validata_base_url.format(schema_url=schema_url, rurl=rurl))
-        time.sleep(0.5)
-        return r.json()
+        return None
+
+
+# Same as get_resource_metadata, within the validation session
+async def fetch_resource_metadata(session, rate_limiter, resource_id, resource_api_url):
+    if resource_id not in resources_metadata:
+        status, text = await get_with_retries(session, rate_limiter, resource_api_url)
+        if status >= 400:
+            raise requests.HTTPError(f"{status} Error for url: {resource_api_url}")
+        resources_metadata[resource_id] = json.loads(text)
+    return resources_metadata[resource_id]
+
+
+# Make the validation report based on the resource url, the resource API-url,
+# the schema url and validation url
+async def make_validata_report(
+    session,
+    rate_limiter,
+    rurl,
+    schema_url,
+    resource_id,
+    resource_api_url,
+    validata_base_url=VALIDATA_BASE_URL,
+):
+    # saves time by not pinging Validata for unchanged resources
+    data = await fetch_resource_metadata(session, rate_limiter, resource_id, resource_api_url)
+    report = get_report_from_metadata(data, resource_api_url)
+    if report is None:
+        report = await get_validata_report(
+            session, rate_limiter, rurl, schema_url, validata_base_url
+        )
+    return report
 
 
 # Returns if a resource is valid or not regarding a schema (version)
-def is_validata_valid(rurl, schema_url, resource_api_url, validata_base_url=VALIDATA_BASE_URL):
+async def is_validata_valid(
+    session,
+    rate_limiter,
+    rurl,
+    schema_url,
+    resource_id,
+    resource_api_url,
+    validata_base_url=VALIDATA_BASE_URL,
+):
     try:
-        report = make_validata_report(rurl, schema_url, resource_api_url, validata_base_url)
+        report = await make_validata_report(
+            session, rate_limiter, rurl, schema_url, resource_id, resource_api_url, validata_base_url
+        )
         try:
             res = report["report"]["valid"]
         except:
@@ -397,14 +547,31 @@ def save_validata_report(
 
 
 # Returns if a resource is valid based on its "ref_table" row
-def is_validata_valid_row(row, schema_url, version, schema_name, validata_reports_path):
+async def is_validata_valid_row(
+    session,
+    rate_limiter,
+    row,
+    schema_url,
+    version,
+    schema_name,
+    validata_reports_path,
+    validata_base_url=VALIDATA_BASE_URL,
+):
     if row["error_type"] is None:  # if no error
         rurl = row["resource_url"]
         resource_api_url = (
             DATAGOUV_URL
             + f'/api/1/datasets/{row["dataset_id"]}/resources/{row["resource_id"]}'
         )
-        res, report = is_validata_valid(rurl, schema_url, resource_api_url)
+        res, report = await is_validata_valid(
+            session,
+            rate_limiter,
+            rurl,
+            schema_url,
+            row["resource_id"],
+            resource_api_url,
+            validata_base_url,
+        )
         if report and not report.get('report', {}).get('hydra:unavailable', False):
             save_validata_report(
                 res,
@@ -420,17 +587,54 @@ def is_validata_valid_row(row, schema_url, version, schema_name, validata_report
         return False
 
 
+# Checks every resource of the ref table against every schema version (name, url):
+# the resources are checked concurrently, within the per host rate limits,
+# returns the validity of the resources by version
+async def validate_resources(
+    df,
+    versions,
+    schema_name,
+    validata_reports_path,
+    validata_base_url=VALIDATA_BASE_URL,
+):
+    rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+    semaphore = asyncio.Semaphore(VALIDATION_MAX_CONCURRENCY)
+
+    # the versions of a resource are checked one after the other,
+    # so that its metadata is retrieved only once
+    async def check(row):
+        async with semaphore:
+            return [
+                await is_validata_valid_row(
+                    session,
+                    rate_limiter,
+                    row,
+                    schema_url,
+                    version_name,
+                    schema_name,
+                    validata_reports_path,
+                    validata_base_url,
+                )
+                for version_name, schema_url in versions
+            ]
+
+    # a single session for the whole run, so that connections are reused for each host
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=VALIDATION_MAX_CONCURRENCY),
+        timeout=aiohttp.ClientTimeout(total=VALIDATION_TIMEOUT),
+    ) as session:
+        results = await asyncio.gather(*[check(row) for _, row in df.iterrows()])
+    return {
+        version_name: [res[k] for res in results]
+        for k, (version_name, _) in enumerate(versions)
+    }
+
+
 # Gets the current metadata of schema version of a resource (based of ref_table row)
 def get_resource_schema_version(row: pd.Series, api_url: str):
-    url = api_url + f'datasets/{row["dataset_id"]}/resources/{row["resource_id"]}/'
-    r = requests.get(url, headers={'X-fields': 'schema'})
-    r.raise_for_status()
-    if r.status_code == 200:
-        r_json = r.json()
-        if r_json.get('schema') and r_json.get('schema').get('version', False):
-            return r_json["schema"]["version"]
-        else:
-            return np.nan
+    schema = get_resource_metadata(row["dataset_id"], row["resource_id"], api_url).get('schema')
+    if schema and schema.get('version', False):
+        return schema["version"]
     else:
         return np.nan
 
@@ -515,6 +719,34 @@ def get_schema_report(
     return schemas_report_dict, schemas_catalogue_list
 
 
+# Applies the validata check for each version that is not explicitly dropped in config file,
+# adds the validity of the resources for each version to the ref table
+# and returns the names of the checked versions
+def add_validity_columns(df, schema_dict, drop_versions, schema_name, validata_reports_path):
+    versions = []
+    for version in schema_dict["versions"]:
+        version_name = version["version_name"]
+        if version_name not in drop_versions:
+            versions += [(version_name, version["schema_url"])]
+        else:
+            print(
+                f"--- ❌ Version {version_name} to drop according to config file"
+            )
+
+    validity = asyncio.run(
+        validate_resources(df, versions, schema_name, validata_reports_path)
+    )
+    # for the update of the resources
+    save_resources_metadata(validata_reports_path)
+    version_names_list = []
+    for version_name, _ in versions:
+        df[f"is_valid_v_{version_name}"] = validity[version_name]
+        version_names_list += [version_name]
+        print(
+            f"--- ☑️ Validata check done for version {version_name}"
+        )
+    return version_names_list
+
 
 def build_reference_table(
     config_dict,
@@ -526,6 +758,7 @@ def build_reference_table(
     should_succeed=False
 ):
     print(f"- ℹ️ STARTING SCHEMA: {schema_name}")
+    load_resources_metadata(validata_reports_path)
     if forced_validation:
         print("🎂 Today is forced validation day!")
 
@@ -640,32 +873,9 @@ def build_reference_table(
             df["initial_version_name"] = np.nan
 
         # FOR EACH RESOURCE AND SCHEMA VERSION, CHECK IF RESOURCE MATCHES THE SCHEMA VERSION
-
-        # Apply validata check for each version that is not explicitly dropped in config file
-        version_names_list = []
-
-        for version in schema_dict["versions"]:
-            version_name = version["version_name"]
-            if version_name not in drop_versions:
-                schema_url = version["schema_url"]
-                df[f"is_valid_v_{version_name}"] = df.apply(
-                    lambda row: is_validata_valid_row(
-                        row,
-                        schema_url,
-                        version_name,
-                        schema_name,
-                        validata_reports_path,
-                    ),
-                    axis=1,
-                )
-                version_names_list += [version_name]
-                print(
-                    f"--- ☑️ Validata check done for version {version_name}"
-                )
-            else:
-                print(
-                    f"--- ❌ Version {version_name} to drop according to config file"
-                )
+        version_names_list = add_validity_columns(
+            df, schema_dict, drop_versions, schema_name, validata_reports_path
+        )
 
         if len(version_names_list) > 0:
             # Check if resources are at least matching one schema version
@@ -709,11 +919,76 @@ def build_reference_table(
     return True
 
 
+# Downloads a resource (based on its "ref_table" row) in the cache, unless it has not changed
+# since it was cached, and copies it in the data folder,
+# returns the validators of the cached file and the download stats
+def download_resource(row, schema_data_path, schema_cache_path, validators, host_semaphores):
+    rurl = row["resource_url"]
+    written_filename = f"{row['resource_id']}.{row['resource_extension']}"
+    cached_file = schema_cache_path / written_filename
+    # the cached file is only reused if the resource still has the same url
+    if not (validators and validators.get("url") == rurl and cached_file.is_file()):
+        validators = None
+    start = time.time()
+    try:
+        with host_semaphores[urlparse(rurl).netloc]:
+            new_validators = download_file(
+                {
+                    "url": rurl,
+                    "dest_path": f"{schema_cache_path}/",
+                    "dest_name": written_filename,
+                },
+                resume=True,
+                validators=validators,
+            )
+    except (requests.RequestException, DownloadError) as e:
+        print(
+            "--- ⬇️❌ File could not be downloaded: [{}] {}".format(
+                row["resource_title"], rurl
+            )
+        )
+        print("Error looks like this:", e)
+        return None, {"is_downloaded": False}
+
+    is_from_cache = new_validators is None
+    if is_from_cache:
+        new_validators = validators
+    else:
+        new_validators["url"] = rurl
+    p = Path(schema_data_path) / row["dataset_slug"]
+    p.mkdir(exist_ok=True)
+    shutil.copyfile(cached_file, p / written_filename)
+    print(
+        "--- ⬇️✅ {} file [{}] {}".format(
+            "cached" if is_from_cache else "downloaded", row["resource_title"], rurl
+        )
+    )
+    return new_validators, {
+        "is_downloaded": True,
+        "file_size": os.path.getsize(cached_file),
+        "download_duration": round(time.time() - start, 3),
+        "is_from_cache": is_from_cache,
+    }
+
+
+# Keeps the validators of the cached files for the next run,
+# the files of the resources that were not retrieved are removed from the cache
+def update_schema_files_cache(schema_cache_path, validators):
+    validators_file = schema_cache_path / "validators.json"
+    with open(f"{validators_file}.tmp", "w") as f:
+        json.dump(validators, f)
+    os.replace(f"{validators_file}.tmp", validators_file)
+    for file in os.listdir(schema_cache_path):
+        if file.split(".")[0] not in validators and not file.startswith("validators"):
+            os.remove(schema_cache_path / file)
+
+
 def download_schema_files(
     schema_name,
     ref_tables_path,
     data_path,
-    should_succeed=False
+    should_succeed=False,
+    cache_path=SCHEMA_FILES_CACHE,
 ):
     print(f"- ℹ️ STARTING SCHEMA: {schema_name}")
 
@@ -725,45 +1000,52 @@ def download_schema_files(
     if os.path.exists(ref_table_path):
         df_ref = pd.read_csv(ref_table_path)
         df_ref["is_downloaded"] = False
+        df_ref["file_size"] = np.nan
+        df_ref["download_duration"] = np.nan
+        df_ref["is_from_cache"] = False
 
         if len(df_ref[df_ref["is_valid_one_version"]]) > 0:
             schema_data_path = Path(data_path) / schema_name.replace("/", "_")
             schema_data_path.mkdir(exist_ok=True)
+            schema_cache_path = Path(cache_path) / schema_name.replace("/", "_")
+            schema_cache_path.mkdir(parents=True, exist_ok=True)
+            validators = {}
+            if (schema_cache_path / "validators.json").is_file():
+                with open(schema_cache_path / "validators.json") as f:
+                    validators = json.load(f)
+
+            rows = [row for _, row in df_ref[df_ref["is_valid_one_version"]].iterrows()]
+            host_semaphores = {
+                urlparse(row["resource_url"]).netloc: threading.BoundedSemaphore(MAX_DOWNLOADS_PER_HOST)
+                for row in rows
+            }
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                results = list(executor.map(
+                    lambda row: download_resource(
+                        row,
+                        schema_data_path,
+                        schema_cache_path,
+                        validators.get(row["resource_id"]),
+                        host_semaphores,
+                    ),
+                    rows,
+                ))
 
-            session = requests.Session()
-            for index, row in df_ref[
-                df_ref["is_valid_one_version"]
-            ].iterrows():
-                rurl = row["resource_url"]
-                r = session.get(rurl, allow_redirects=True)
-
-                if r.status_code == 200:
-                    p = Path(schema_data_path) / row["dataset_slug"]
-                    p.mkdir(exist_ok=True)
-                    file_extension = row["resource_extension"]
-                    written_filename = f"{row['resource_id']}.{file_extension}"
-
-                    with open(f"{p}/{written_filename}", "wb") as f:
-                        f.write(r.content)
-
+            new_validators = {}
+            for row, (resource_validators, stats) in zip(rows, results):
+                for column, value in stats.items():
                     df_ref.loc[
                         (df_ref["resource_id"] == row["resource_id"]),
-                        "is_downloaded",
-                    ] = True
-
-                    print(
-                        "--- ⬇️✅ downloaded file [{}] {}".format(
-                            row["resource_title"], rurl
-                        )
-                    )
-                else:
-                    print(
-                        "--- ⬇️❌ File could not be downloaded: [{}] {}".format(
-                            row["resource_title"], rurl
-                        )
-                    )
-                    print("Error looks like this:", r.text)
-            session.close()
+                        column,
+                    ] = value
+                if resource_validators is not None:
+                    new_validators[row["resource_id"]] = resource_validators
+            update_schema_files_cache(schema_cache_path, new_validators)
+            print(
+                f"-- {int(df_ref['is_downloaded'].sum())} file(s) retrieved,",
+                f"{int(df_ref['is_from_cache'].sum())} from cache",
+                f"({int(df_ref['file_size'].sum())} bytes)",
+            )
 
         else:
             print(
@@ -787,6 +1069,69 @@ def download_schema_files(
     return True
 
 
+# chardet mistakes some latin-1 files for Windows-1254
+def chardet_encoding(data):
+    encoding = chardet.detect(data).get("encoding")
+    if encoding == "Windows-1254":
+        encoding = "iso-8859-1"
+    return encoding
+
+
+# Guesses the encoding of a file from its beginning: most files are in utf-8,
+# the (slow) chardet detection only runs for the others
+def detect_encoding(file_path, sample_size=ENCODING_SAMPLE_SIZE):
+    with open(file_path, "rb") as f:
+        sample = f.read(sample_size)
+    try:
+        # the sample may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+        # also removes the BOM, if any
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return chardet_encoding(sample)
+
+
+# Reads a resource with the C engine, using the delimiter that the python engine
+# would find with sep=None (sniffed from the first line)
+def read_csv_resource(file_path):
+    try:
+        encoding = detect_encoding(file_path)
+        with open(file_path, encoding=encoding, newline="") as f:
+            delimiter = csv.Sniffer().sniff(f.readline()).delimiter
+        return pd.read_csv(
+            file_path,
+            sep=delimiter,
+            dtype="str",
+            encoding=encoding,
+            na_filter=False,
+            keep_default_na=False,
+        )
+    except (UnicodeDecodeError, pd.errors.ParserError) as e:
+        # the beginning of the file was not enough to guess its encoding,
+        # or the file is too malformed for the C engine
+        print(f"Falling back to the python engine for {file_path} ({e})")
+        with open(file_path, "rb") as f:
+            encoding = chardet_encoding(f.read())
+        return pd.read_csv(
+            file_path,
+            sep=None,
+            engine="python",
+            dtype="str",
+            encoding=encoding,
+            na_filter=False,
+            keep_default_na=False,
+        )
+
+
+# Removes the line breaks in the values, only in the columns that contain some
+# (by position, as the column names may be duplicated)
+def remove_line_breaks(df_r):
+    for k in range(df_r.shape[1]):
+        values = df_r.iloc[:, k].str.cat()
+        if '\n' in values or '\r' in values:
+            df_r.isetitem(k, df_r.iloc[:, k].str.replace('[\n\r]', '', regex=True))
+
+
 def consolidate_data(
     data_path,
     schema_name,
@@ -866,22 +1211,7 @@ def consolidate_data(
 
                         try:
                             if file_path.endswith(".csv"):
-                                with open(file_path, "rb") as f:
-                                    encoding = chardet.detect(f.read()).get(
-                                        "encoding"
-                                    )
-                                if encoding == "Windows-1254":
-                                    encoding = "iso-8859-1"
-
-                                df_r = pd.read_csv(
-                                    file_path,
-                                    sep=None,
-                                    engine="python",
-                                    dtype="str",
-                                    encoding=encoding,
-                                    na_filter=False,
-                                    keep_default_na=False,
-                                )
+                                df_r = read_csv_resource(file_path)
                             else:
                                 df_r = pd.read_excel(
                                     file_path,
@@ -899,11 +1229,7 @@ def consolidate_data(
                             df_r.columns = [c.replace(' ', '') for c in df_r.columns]
                             # Remove potential unwanted characters
                             # (eg https://www.data.gouv.fr/fr/datasets/r/67ed303d-1b3a-49d1-afb4-6c0e4318cc20)
-                            for c in df_r.columns:
-                                df_r[c] = df_r[c].apply(
-                                    lambda s: s.replace('\n', '').replace('\r', '')
-                                    if isinstance(s, str) else s
-                                )
+                            remove_line_breaks(df_r)
                             if len(df_r) > 0:  # Keeping only non empty files
                                 # Discard columns that are not in the current schema version
                                 df_r = df_r[
@@ -1132,9 +1458,7 @@ def update_resource_metadata(
 
         try:
             url = api_url + f"datasets/{dataset_id}/resources/{resource_id}/"
-            r = requests.get(url, headers={"X-fields": "schema"})
-            r.raise_for_status()
-            schema_from_resource = r.json()["schema"]
+            schema_from_resource = get_resource_metadata(dataset_id, resource_id, api_url)["schema"]
             # if the resource already has a schema mentionned in its metadata, we don't
             # change it, we display how it is, but don't throw an error anymore
             if schema_from_resource and schema_from_resource.get("name") != schema_name:
@@ -1178,6 +1502,8 @@ def update_resource_metadata(
                     return False
             else:
                 print("Schema metadata updated with:", obj)
+                # the resource may be checked again for another schema
+                resources_metadata[resource_id]["schema"] = schema_from_consolidation
         else:
             print("Not updating schema metadata")
 
@@ -1509,6 +1835,7 @@ def update_resource_send_mail_producer(
     send_mails=False,
 ):
     print(f"- ℹ️ STARTING SCHEMA: {schema_name}")
+    load_resources_metadata(validata_reports_path)
 
     ref_table_path = os.path.join(
         ref_tables_path,
@@ -1722,6 +2049,7 @@ def update_resource_send_mail_producer(
                 ] = False
 
         df_ref.to_csv(ref_table_path, index=False)
+        save_resources_metadata(validata_reports_path)
 
         print(f"- ✅ Resources updated for schema {schema_name}")
 